@@ -0,0 +1,73 @@
+import re
+import logging
+
+from media_cache import canonical_key_from_url
+
+logger = logging.getLogger("telegram_bot.batch")
+
+# تيليغرام بيقبل 2-10 عناصر بكل sendMediaGroup
+MEDIA_GROUP_SIZE = 10
+
+_URL_RE = re.compile(r"https?://[^\s<>\"']+", re.IGNORECASE)
+# علامات ترقيم بتلزق بآخر الرابط بالنص العادي
+_TRAILING = ".,;:!?)]}»،؛؟"
+
+_YOUTUBE_PLAYLIST_RE = re.compile(r"youtube\.com/playlist\?(?:.*&)?list=", re.IGNORECASE)
+_TIKTOK_PROFILE_RE = re.compile(r"tiktok\.com/@[^/?#\s]+/?(?:[?#]|$)", re.IGNORECASE)
+
+
+def extract_urls(text: str, limit: int = 0) -> list[str]:
+    """Every http(s) link in `text`, in order, without duplicates (same video = same link)."""
+    urls: list[str] = []
+    seen: set[str] = set()
+    for m in _URL_RE.finditer(text or ""):
+        url = m.group(0).rstrip(_TRAILING)
+        key = canonical_key_from_url(url) or url
+        if key in seen:
+            continue
+        seen.add(key)
+        urls.append(url)
+        if limit and len(urls) >= limit:
+            break
+    return urls
+
+def is_collection_url(url: str) -> bool:
+    # playlist يوتيوب أو بروفايل تيك توك (مش watch?v=…&list=…، هيدا فيديو واحد)
+    return bool(_YOUTUBE_PLAYLIST_RE.search(url) or _TIKTOK_PROFILE_RE.search(url))
+
+def flat_entry_urls(info: dict) -> list[str]:
+    # entries تبع extract_flat: كل واحد فيه url (أو webpage_url) للفيديو
+    urls = []
+    for entry in info.get("entries") or []:
+        if not entry:
+            continue
+        url = entry.get("webpage_url") or entry.get("url")
+        if isinstance(url, str) and url.startswith(("http://", "https://")):
+            urls.append(url)
+    return urls
+
+
+class BatchProgress:
+    """Counts for one batch, rendered into its single status message."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.ready = 0
+        self.sent = 0
+        self.failed: list[str] = []
+
+    def render(self) -> str:
+        lines = [f"📦 {self.total} فيديو: جاهز {self.ready}/{self.total}، انبعت {self.sent}"]
+        if self.failed:
+            lines.append(f"⚠️ فشل {len(self.failed)}")
+        return "\n".join(lines)
+
+    def summary(self) -> str:
+        if not self.sent:
+            return f"⚠️ فشل تحميل كل الفيديوهات ({self.total})."
+        text = f"✅ تم الإرسال بنجاح: {self.sent}/{self.total} فيديو"
+        if self.failed:
+            text += "\n⚠️ ما قدرت حمّل:\n" + "\n".join(self.failed[:10])
+            if len(self.failed) > 10:
+                text += f"\n… و{len(self.failed) - 10} غيرهم"
+        return text
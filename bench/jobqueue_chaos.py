@@ -0,0 +1,337 @@
+"""
+Multi-process crash test for RUN_MODE=web + RUN_MODE=worker.
+
+Boots main.py as one webhook front end and several download workers sharing
+a fresh SQLite job queue, all against the stand-in Bot API and stub extractor
+from bench/loadtest.py. Webhook updates (single links and multi-link batches,
+one chat each) go through download_video -> job queue -> handle_job ->
+process_link / process_batch, exactly like production. Workers are SIGKILLed
+(or SIGTERMed) right after a random Bot API call of theirs, mid-download or
+mid-upload, and a replacement is started each time.
+
+    python bench/jobqueue_chaos.py --jobs 60 --workers 3 --kills 15
+
+Every document the fake API receives is counted per chat and video. The check
+passes when every job is done and every video reached its chat. A video that
+reached its chat twice is allowed only if the worker that sent it first died
+before that send was checkpointed (the job's checkpoint is read right after
+the worker exits). Any other duplicate means a retry re-sent something it
+had recorded as delivered, and the run fails.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import signal
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+from pathlib import Path
+
+import httpx
+from tornado.httpserver import HTTPServer
+from tornado.web import Application
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+
+import loadtest  # noqa: E402
+
+_VIDEO_RE = re.compile(r"/v/([\w-]+)")
+
+
+# =========================
+# Fake Bot API (per-worker base URL: /w<n>/bot<token>/<method>)
+# =========================
+class ChaosBotApiHandler(loadtest.FakeBotApiHandler):
+    async def post(self, worker: str, token: str, method: str):
+        CHAOS.on_api_call(int(worker), self, method.lower())
+        await super().post(token, method)
+
+    def write(self, chunk):
+        # file_id -> الفيديو، حتى نعرف شو انبعت لما الـ bot يعيد يبعت file_id
+        if isinstance(chunk, dict) and chunk.get("ok"):
+            results = chunk["result"] if isinstance(chunk["result"], list) else [chunk["result"]]
+            for message in results:
+                document = message.get("document") if isinstance(message, dict) else None
+                if document and document["file_name"].startswith("bench "):
+                    CHAOS.file_videos[document["file_id"]] = document["file_name"][len("bench "):].rsplit(".", 1)[0]
+        super().write(chunk)
+
+
+# =========================
+# Supervisor
+# =========================
+class Chaos:
+    def __init__(self, args, workdir: Path):
+        self.args = args
+        self.workdir = workdir
+        self.db = workdir / "jobs.sqlite3"
+        self.log = (workdir / "workers.log").open("ab")
+        self.env: dict = {}
+        self.next_worker = 1
+        self.procs: dict[int, asyncio.subprocess.Process] = {}
+        self.kills_left = args.kills
+        self.killed = {"SIGKILL": 0, "SIGTERM": 0}
+        self.stopping = False
+        self.tasks: set[asyncio.Task] = set()
+
+        self.file_videos: dict[str, str] = {}
+        # (chat, video) -> كم مرة وصل، ومين بعته
+        self.delivered: Counter = Counter()
+        self.sent_by: dict[int, list[tuple[int, str]]] = {}
+        # وصل، والـ worker مات قبل ما يسجّله بالـ checkpoint (الـ duplicate هون مسموح)
+        self.unacked_at_death: set[tuple[int, str]] = set()
+
+    # -------- API hooks --------
+    def on_api_call(self, worker: int, handler: ChaosBotApiHandler, method: str) -> None:
+        chat_id = int(handler._arg("chat_id", 0) or 0)
+        videos = []
+        if method == "senddocument":
+            upload = handler._upload("document")
+            videos.append(self._video(upload[0] if upload else None, handler._arg("document")))
+        elif method == "sendmediagroup":
+            for item in json.loads(handler._arg("media", "[]")):
+                ref = str(item.get("media", ""))
+                upload = handler._upload(ref.removeprefix("attach://")) if ref.startswith("attach://") else None
+                videos.append(self._video(upload[0] if upload else None, ref))
+        for video in videos:
+            self.delivered[(chat_id, video)] += 1
+            self.sent_by.setdefault(worker, []).append((chat_id, video))
+
+        # منقتل الـ worker شوي بعد أي طلب إلو: بنص التحميل، بعد الإرسال، أو بين الإرسال والـ checkpoint
+        proc = self.procs.get(worker)
+        if proc is not None and self.kills_left > 0 and random.random() < self.args.kill_rate:
+            self.kills_left -= 1
+            self._track(self.kill(worker, proc, random.uniform(0, self.args.kill_delay)))
+
+    def _video(self, filename: str | None, ref: str | None) -> str:
+        if filename and filename.startswith("bench "):
+            return filename[len("bench "):].rsplit(".", 1)[0]
+        return self.file_videos.get(ref or "", f"?{ref}")
+
+    # -------- processes --------
+    async def spawn(self) -> None:
+        n = self.next_worker
+        self.next_worker += 1
+        env = {
+            **self.env,
+            "RUN_MODE": "worker",
+            "WORKER_ID": f"chaos-{n}",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{self.args.api_port}/w{n}",
+        }
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(ROOT / "main.py"), env=env, stdout=self.log, stderr=asyncio.subprocess.STDOUT,
+        )
+        self.procs[n] = proc
+        self._track(self.watch(n, proc))
+
+    def _track(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def watch(self, n: int, proc: asyncio.subprocess.Process) -> None:
+        await proc.wait()
+        del self.procs[n]
+        # الـ process ميت: الـ checkpoint تبعه نهائي -> شو بعت وما سجّل
+        checkpointed = self.checkpointed()
+        for sent in self.sent_by.get(n, []):
+            if sent not in checkpointed:
+                self.unacked_at_death.add(sent)
+        if not self.stopping:
+            await self.spawn()
+
+    async def kill(self, n: int, proc: asyncio.subprocess.Process, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if proc.returncode is not None:
+            return
+        sig = signal.SIGTERM if random.random() < self.args.term_rate else signal.SIGKILL
+        proc.send_signal(sig)
+        self.killed[sig.name] += 1
+
+    async def stop(self) -> None:
+        self.stopping = True
+        for proc in list(self.procs.values()):
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.log.close()
+
+    # -------- queue state --------
+    def rows(self) -> list[tuple]:
+        if not self.db.exists():
+            return []
+        with contextlib.closing(sqlite3.connect(str(self.db), timeout=30)) as db:
+            return db.execute("SELECT payload, state, attempts, result, checkpoint FROM jobs").fetchall()
+
+    def checkpointed(self) -> set[tuple[int, str]]:
+        done = set()
+        for payload, _, _, _, checkpoint in self.rows():
+            chat_id = json.loads(payload)["update"]["message"]["chat"]["id"]
+            for url in json.loads(checkpoint or "{}").get("delivered", []):
+                done.add((chat_id, _VIDEO_RE.search(url).group(1)))
+        return done
+
+
+def chaos_updates(args) -> list[dict]:
+    # chat واحد لكل job، وفيديوهات مختلفة (ما في coalescing بين الـ jobs)
+    updates = []
+    for i in range(args.jobs):
+        n = args.batch_links if random.random() < args.batch_rate else 1
+        links = [
+            f"https://bench.invalid/v/c{i}-{j}?size={args.size}&latency={args.latency}" for j in range(n)
+        ]
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": 10_000 + i, "type": "private"},
+                "from": {"id": 20_000 + i, "is_bot": False, "first_name": f"user{i}"},
+                "text": "\n".join(links),
+            },
+        })
+    return updates
+
+
+CHAOS: Chaos
+
+
+async def run(args) -> int:
+    global CHAOS
+    loadtest.STATE = loadtest.BenchState(upload_latency=args.upload_latency, flood_rate=0)
+    workdir = Path(tempfile.mkdtemp(prefix="jobqueue-chaos-"))
+    CHAOS = chaos = Chaos(args, workdir)
+
+    api = HTTPServer(Application([(r"/w(\d+)/bot([^/]+)/(\w+)", ChaosBotApiHandler)]), max_body_size=1 << 31)
+    api.listen(args.api_port, "127.0.0.1")
+    media = HTTPServer(Application([(r"/(\d+)", loadtest.MediaHandler)]))
+    media.listen(args.media_port, "127.0.0.1")
+
+    chaos.env = {
+        **os.environ,
+        "BOT_TOKEN": loadtest.TOKEN,
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.bot_port}",
+        "WEBHOOK_SECRET": loadtest.SECRET,
+        "PORT": str(args.bot_port),
+        "BENCH_MEDIA_URL": f"http://127.0.0.1:{args.media_port}",
+        "MEDIA_CACHE_PATH": str(workdir / "media_cache.sqlite3"),
+        "DOWNLOAD_DIR": str(workdir / "downloads"),
+        "JOB_QUEUE_URL": str(chaos.db),
+        "JOB_LEASE_SECONDS": str(args.lease),
+        "JOB_POLL_INTERVAL": str(args.poll),
+        "JOB_MAX_ATTEMPTS": str(args.kills + 3),
+        "SHUTDOWN_DRAIN_TIMEOUT": str(args.drain),
+        "DOWNLOAD_WORKERS": str(args.concurrency),
+        "DOWNLOAD_QUEUE_MAX": str(args.jobs * 10),
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(BENCH_DIR), os.getenv("PYTHONPATH")])),
+    }
+    web_env = {**chaos.env, "RUN_MODE": "web", "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}/w0"}
+    with (workdir / "web.log").open("wb") as log:
+        web = await asyncio.create_subprocess_exec(
+            sys.executable, str(ROOT / "main.py"), env=web_env, stdout=log, stderr=asyncio.subprocess.STDOUT,
+        )
+
+    try:
+        try:
+            await asyncio.wait_for(loadtest.STATE.ready.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            print(f"web front end did not call setWebhook within 60s, see {workdir / 'web.log'}")
+            return 1
+
+        for _ in range(args.workers):
+            await chaos.spawn()
+
+        updates = chaos_updates(args)
+        expected = {
+            (u["message"]["chat"]["id"], _VIDEO_RE.search(line).group(1))
+            for u in updates for line in u["message"]["text"].splitlines()
+        }
+        webhook = f"http://127.0.0.1:{args.bot_port}/webhook/{loadtest.SECRET}"
+        rejected: list = []
+        t0 = time.perf_counter()
+        async with httpx.AsyncClient(timeout=30) as client:
+            await asyncio.gather(*(loadtest.fire(client, webhook, u, rejected) for u in updates))
+
+        deadline = t0 + args.timeout
+        while time.perf_counter() < deadline:
+            rows = chaos.rows()
+            if len(rows) >= len(updates) and all(state == "done" for _, state, *_ in rows):
+                break
+            await asyncio.sleep(0.2)
+        elapsed = time.perf_counter() - t0
+    finally:
+        await chaos.stop()
+        if web.returncode is None:
+            web.send_signal(signal.SIGTERM)
+        await web.wait()
+        api.stop()
+        media.stop()
+
+    rows = chaos.rows()
+    done = sum(1 for _, state, *_ in rows if state == "done")
+    outcomes = Counter(json.loads(result or "{}").get("outcome", "?") for _, state, _, result, _ in rows if state == "done")
+    retried_after_delivery = sum(
+        1 for _, _, attempts, _, checkpoint in rows if attempts > 1 and json.loads(checkpoint or "{}").get("delivered")
+    )
+    missing = sorted(expected - set(chaos.delivered))
+    unexpected = sorted(set(chaos.delivered) - expected)
+    duplicated = {k: n for k, n in chaos.delivered.items() if n > 1}
+    unexplained = {k: n for k, n in duplicated.items() if k not in chaos.unacked_at_death}
+
+    print(f"jobs         {args.jobs} ({len(expected)} videos) on {args.workers} workers, lease={args.lease}s")
+    print(f"finished     {done}/{len(updates)} done in {elapsed:.2f}s  outcomes={dict(outcomes)}  rejected={len(rejected)}")
+    print(f"killed       {chaos.killed}  workers started={chaos.next_worker - 1}")
+    print(f"retries      {retried_after_delivery} jobs re-leased after a checkpointed delivery")
+    print(
+        f"delivered    {len(chaos.delivered)} videos  missing={len(missing)}  duplicated={len(duplicated)}"
+        f"  (sent but not checkpointed at death: {len(duplicated) - len(unexplained)}, unexplained: {len(unexplained)})"
+    )
+    if missing:
+        print(f"  missing    {missing[:20]}")
+    if unexpected:
+        print(f"  unexpected {unexpected[:20]}")
+    if unexplained:
+        print(f"  unexplained duplicates {dict(list(unexplained.items())[:20])}")
+    print(f"workdir      {workdir}")
+
+    ok = done == len(updates) and not missing and not unexpected and not unexplained and not rejected
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 2
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=40, help="webhook updates (one chat each)")
+    parser.add_argument("--batch-rate", type=float, default=0.3, help="fraction of updates that are multi-link batches")
+    parser.add_argument("--batch-links", type=int, default=3, help="links per batch update")
+    parser.add_argument("--workers", type=int, default=3, help="concurrent worker processes")
+    parser.add_argument("--concurrency", type=int, default=2, help="jobs per worker process at a time")
+    parser.add_argument("--kills", type=int, default=10, help="how many workers to kill")
+    parser.add_argument("--kill-rate", type=float, default=0.1, help="chance a worker's Bot API call triggers a kill")
+    parser.add_argument("--kill-delay", type=float, default=0.3, help="kill up to this many seconds after that call")
+    parser.add_argument("--term-rate", type=float, default=0.3, help="fraction of kills that are SIGTERM (graceful)")
+    parser.add_argument("--size", type=loadtest.parse_size, default=loadtest.parse_size("512KB"), help="synthetic media size")
+    parser.add_argument("--latency", type=float, default=0.2, help="extractor latency per video, seconds")
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="fake API delay per file upload, seconds")
+    parser.add_argument("--lease", type=float, default=3.0, help="JOB_LEASE_SECONDS")
+    parser.add_argument("--poll", type=float, default=0.1, help="JOB_POLL_INTERVAL")
+    parser.add_argument("--drain", type=float, default=3.0, help="SHUTDOWN_DRAIN_TIMEOUT for SIGTERMed workers")
+    parser.add_argument("--timeout", type=float, default=300, help="give up after this many seconds")
+    parser.add_argument("--bot-port", type=int, default=18090)
+    parser.add_argument("--api-port", type=int, default=18091)
+    parser.add_argument("--media-port", type=int, default=18092)
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
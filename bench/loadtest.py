@@ -0,0 +1,400 @@
+"""
+Offline load test: webhook -> application.process_update -> download_video.
+
+Boots main.py as a subprocess against a local stand-in Bot API server and a
+stub yt-dlp extractor (bench/yt_dlp_plugins), fires webhook updates at a fixed
+rate and reports end-to-end latency, throughput, peak RSS and open fds.
+
+    python bench/loadtest.py --rate 20 --count 200 --size 2MB --latency 0.2
+
+End-to-end latency is measured from the webhook POST until the bot's final
+status edit (sent / failed / rejected) reaches the fake API. No real token or
+network access is needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+from pathlib import Path
+
+import httpx
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+
+TOKEN = "123456:bench"
+SECRET = "bench_secret"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+# الرسالة الأخيرة يلي بتسكّر الطلب (من download_video)
+FINAL_PREFIXES = {
+    "✅ تم الإرسال": "sent",
+    "⚠️": "failed",
+    "🚦": "rejected",
+}
+
+
+def parse_size(raw: str) -> int:
+    raw = raw.strip().upper()
+    for suffix, mult in (("GB", 1 << 30), ("MB", 1 << 20), ("KB", 1 << 10), ("B", 1)):
+        if raw.endswith(suffix):
+            return int(float(raw[: -len(suffix)]) * mult)
+    return int(raw)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# =========================
+# Fake Telegram Bot API
+# =========================
+class BenchState:
+    def __init__(self, upload_latency: float, flood_rate: float):
+        self.upload_latency = upload_latency
+        self.flood_rate = flood_rate
+        self.flooded = 0
+        self.ready = asyncio.Event()
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.calls: dict[str, int] = {}
+        self.sent_at: dict[int, float] = {}
+        self.done: dict[int, tuple[float, str]] = {}
+        self.all_done = asyncio.Event()
+        self.expected = 0
+
+    def finish(self, chat_id: int, outcome: str) -> None:
+        if chat_id in self.sent_at and chat_id not in self.done:
+            self.done[chat_id] = (time.perf_counter(), outcome)
+            if len(self.done) >= self.expected:
+                self.all_done.set()
+
+
+def _message(chat_id: int, **extra) -> dict:
+    return {
+        "message_id": extra.pop("message_id", None) or next(STATE.message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": BOT_USER,
+        **extra,
+    }
+
+
+def _document(name: str, size: int) -> dict:
+    n = next(STATE.file_ids)
+    return {"file_id": f"bench-file-{n}", "file_unique_id": f"u{n}", "file_name": name, "file_size": size}
+
+
+class FakeBotApiHandler(RequestHandler):
+    def check_xsrf_cookie(self):
+        pass
+
+    def _arg(self, name: str, default=None):
+        value = self.get_body_argument(name, None) or self.get_query_argument(name, None)
+        return default if value is None else value
+
+    def _upload(self, field: str) -> tuple[str, int] | None:
+        files = self.request.files.get(field)
+        if files:
+            return files[0].filename or "file", len(files[0].body)
+        return None
+
+    async def post(self, token: str, method: str):
+        method = method.lower()
+        STATE.calls[method] = STATE.calls.get(method, 0) + 1
+        if token != TOKEN:
+            self.set_status(401)
+            self.write({"ok": False, "error_code": 401, "description": "Unauthorized"})
+            return
+
+        chat_id = int(self._arg("chat_id", 0) or 0)
+        # flood limit مصطنع (429 + retry_after) متل تيليغرام
+        if chat_id and STATE.flood_rate and random.random() < STATE.flood_rate:
+            STATE.flooded += 1
+            self.set_status(429)
+            self.write({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+            })
+            return
+
+        if method == "getme":
+            result = BOT_USER
+        elif method == "setwebhook":
+            STATE.ready.set()
+            result = True
+        elif method == "sendmessage":
+            result = _message(chat_id, text=self._arg("text", ""))
+        elif method == "editmessagetext":
+            text = self._arg("text", "")
+            result = _message(chat_id, message_id=int(self._arg("message_id", 0)), text=text)
+            for prefix, outcome in FINAL_PREFIXES.items():
+                if text.startswith(prefix):
+                    STATE.finish(chat_id, outcome)
+        elif method == "senddocument":
+            upload = self._upload("document")
+            if upload and STATE.upload_latency:
+                await asyncio.sleep(STATE.upload_latency)
+            name, size = upload or ("cached.mp4", 0)
+            result = _message(chat_id, document=_document(name, size))
+        elif method == "sendmediagroup":
+            media = json.loads(self._arg("media", "[]"))
+            if self.request.files and STATE.upload_latency:
+                await asyncio.sleep(STATE.upload_latency)
+            result = []
+            for item in media:
+                ref = str(item.get("media", ""))
+                upload = self._upload(ref.removeprefix("attach://")) if ref.startswith("attach://") else None
+                name, size = upload or ("cached.mp4", 0)
+                result.append(_message(chat_id, document=_document(name, size)))
+        else:
+            result = True
+
+        self.write({"ok": True, "result": result})
+
+
+class MediaHandler(RequestHandler):
+    CHUNK = b"\0" * (256 * 1024)
+
+    async def get(self, size: str):
+        size = int(size)
+        self.set_header("Content-Type", "video/mp4")
+        self.set_header("Content-Length", str(size))
+        sent = 0
+        while sent < size:
+            chunk = self.CHUNK[: min(len(self.CHUNK), size - sent)]
+            self.write(chunk)
+            await self.flush()
+            sent += len(chunk)
+
+
+STATE: BenchState
+
+
+# =========================
+# Bot process sampling
+# =========================
+def sample_process(pid: int) -> tuple[int, int]:
+    rss = 0
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (FileNotFoundError, ProcessLookupError):
+        return 0, 0
+    return rss, fds
+
+
+async def sampler(pid: int, peaks: dict, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        rss, fds = sample_process(pid)
+        peaks["rss"] = max(peaks["rss"], rss)
+        peaks["fds"] = max(peaks["fds"], fds)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+# =========================
+# Load generation
+# =========================
+def generated_updates(args) -> list[dict]:
+    updates = []
+    ids: list[str] = []
+    for i in range(args.count):
+        links = []
+        for j in range(args.links):
+            if ids and random.random() < args.repeat:
+                video_id = random.choice(ids)
+            else:
+                video_id = f"v{i}" if args.links == 1 else f"v{i}-{j}"
+                ids.append(video_id)
+            links.append(f"https://bench.invalid/v/{video_id}?size={args.size}&latency={args.latency}")
+        chat_id = 10_000 + i
+        user_id = 20_000 + (i % args.users if args.users else i)
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": "\n".join(links),
+            },
+        })
+    return updates
+
+
+def recorded_updates(path: Path, count: int) -> list[dict]:
+    # JSONL، update واحد بكل سطر؛ منعطي كل واحد chat_id فريد حتى نقدر نقيس كل طلب لحاله
+    updates = []
+    for i, line in enumerate(itertools.islice(path.read_text().splitlines(), count or None)):
+        update = json.loads(line)
+        update["update_id"] = i + 1
+        update["message"]["chat"]["id"] = 10_000 + i
+        updates.append(update)
+    return updates
+
+
+async def fire(client: httpx.AsyncClient, url: str, update: dict, rejected: list) -> None:
+    chat_id = update["message"]["chat"]["id"]
+    STATE.sent_at[chat_id] = time.perf_counter()
+    try:
+        r = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        if r.status_code != 200:
+            rejected.append(r.status_code)
+            STATE.finish(chat_id, f"http_{r.status_code}")
+    except httpx.HTTPError as e:
+        rejected.append(type(e).__name__)
+        STATE.finish(chat_id, "http_error")
+
+
+async def run(args) -> int:
+    global STATE
+    STATE = BenchState(args.upload_latency, args.flood_rate)
+
+    api = HTTPServer(Application([(r"/bot([^/]+)/(\w+)", FakeBotApiHandler)]), max_body_size=1 << 31)
+    api.listen(args.api_port, "127.0.0.1")
+    media = HTTPServer(Application([(r"/(\d+)", MediaHandler)]))
+    media.listen(args.media_port, "127.0.0.1")
+
+    workdir = Path(tempfile.mkdtemp(prefix="bot-bench-"))
+    env = {
+        **os.environ,
+        "BOT_TOKEN": TOKEN,
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.bot_port}",
+        "WEBHOOK_SECRET": SECRET,
+        "PORT": str(args.bot_port),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}",
+        "BENCH_MEDIA_URL": f"http://127.0.0.1:{args.media_port}",
+        "MEDIA_CACHE_PATH": str(workdir / "media_cache.sqlite3"),
+        "DOWNLOAD_DIR": str(workdir / "downloads"),
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(BENCH_DIR), os.getenv("PYTHONPATH")])),
+    }
+    for item in args.bot_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    log_path = workdir / "bot.log"
+    with log_path.open("wb") as log:
+        bot = subprocess.Popen([sys.executable, str(ROOT / "main.py")], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        try:
+            await asyncio.wait_for(STATE.ready.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            print(f"bot did not call setWebhook within 60s, see {log_path}")
+            return 1
+
+        updates = recorded_updates(Path(args.payloads), args.count) if args.payloads else generated_updates(args)
+        STATE.expected = len(updates)
+        webhook = f"http://127.0.0.1:{args.bot_port}/webhook/{SECRET}"
+
+        peaks = {"rss": 0, "fds": 0}
+        stop = asyncio.Event()
+        sampling = asyncio.create_task(sampler(bot.pid, peaks, stop))
+
+        rejected: list = []
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            t_start = time.perf_counter()
+            tasks = []
+            for i, update in enumerate(updates):
+                delay = t_start + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(fire(client, webhook, update, rejected)))
+            await asyncio.gather(*tasks)
+
+            try:
+                await asyncio.wait_for(STATE.all_done.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            t_end = time.perf_counter()
+
+            try:
+                metrics = (await client.get(f"http://127.0.0.1:{args.bot_port}/metrics")).text
+            except httpx.HTTPError:
+                metrics = ""
+
+        stop.set()
+        await sampling
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+        media.stop()
+
+    report(args, updates, t_start, t_end, peaks, rejected, metrics, log_path)
+    return 0 if len(STATE.done) == len(updates) else 2
+
+
+def report(args, updates, t_start, t_end, peaks, rejected, metrics, log_path) -> None:
+    latencies = [done - STATE.sent_at[chat] for chat, (done, _) in STATE.done.items()]
+    outcomes: dict[str, int] = {}
+    for _, outcome in STATE.done.values():
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    completed = outcomes.get("sent", 0)
+    elapsed = t_end - t_start
+
+    print(
+        f"updates      {len(updates)} at {args.rate}/s, links={args.links} size={args.size}B"
+        f" latency={args.latency}s repeat={args.repeat}"
+    )
+    print(f"finished     {len(STATE.done)}/{len(updates)} in {elapsed:.2f}s  outcomes={outcomes}")
+    print(f"throughput   {completed / elapsed:.2f} sent/s  ({len(STATE.done) / elapsed:.2f} finished/s)")
+    print(
+        f"latency      p50={percentile(latencies, 50) * 1000:.0f}ms  p95={percentile(latencies, 95) * 1000:.0f}ms"
+        f"  p99={percentile(latencies, 99) * 1000:.0f}ms  max={max(latencies, default=0) * 1000:.0f}ms"
+    )
+    print(f"bot process  peak RSS={peaks['rss'] / 1024 / 1024:.1f}MB  peak open fds={peaks['fds']}")
+    print(f"api calls    {dict(sorted(STATE.calls.items()))}  (429 injected: {STATE.flooded})")
+    if rejected:
+        print(f"rejected     {len(rejected)} webhook posts: {sorted(set(map(str, rejected)))}")
+    if args.show_metrics and metrics:
+        print("\n".join(line for line in metrics.splitlines() if line.startswith(("bot_jobs_total", "bot_stage_seconds_sum"))))
+    print(f"bot log      {log_path}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=10, help="webhook updates per second")
+    parser.add_argument("--count", type=int, default=100, help="number of updates to send")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1MB"), help="synthetic media size (e.g. 512KB, 5MB)")
+    parser.add_argument("--latency", type=float, default=0.0, help="extractor latency per video, seconds")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="fake API delay per file upload, seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of chat API calls answered with 429")
+    parser.add_argument("--repeat", type=float, default=0.0, help="fraction of links that reuse an earlier video id")
+    parser.add_argument("--links", type=int, default=1, help="links per message (>1 exercises batch mode)")
+    parser.add_argument("--users", type=int, default=0, help="distinct senders (0 = one per update)")
+    parser.add_argument("--payloads", help="replay recorded updates from a JSONL file instead of generating")
+    parser.add_argument("--connections", type=int, default=100, help="max concurrent webhook connections")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the last reply")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the bot")
+    parser.add_argument("--show-metrics", action="store_true", help="print job/stage totals from /metrics")
+    parser.add_argument("--bot-port", type=int, default=18080)
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--media-port", type=int, default=18082)
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Microbenchmark: per-job yt-dlp setup cost, fresh YoutubeDL per job vs the pool.
+
+    python bench/ydl_setup.py [iterations]
+
+No network: only option building, YoutubeDL construction, cookie loading and
+teardown are measured (the part that used to run on every message).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import statistics
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TMP = Path(tempfile.mkdtemp(prefix="ydl-bench-"))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("WEBHOOK_URL", "http://127.0.0.1")
+os.environ.setdefault("WEBHOOK_SECRET", "bench")
+os.environ["MEDIA_CACHE_PATH"] = str(TMP / "media_cache.sqlite3")
+
+import logging  # noqa: E402
+
+import yt_dlp  # noqa: E402
+
+import main  # noqa: E402
+from ydl_pool import YdlPool  # noqa: E402
+
+logging.getLogger("telegram_bot").setLevel(logging.WARNING)
+
+# نسخة من cookies.txt حتى الـ close() القديم ما يكتب فوق الأصلي
+if (ROOT / "cookies.txt").exists():
+    shutil.copy(ROOT / "cookies.txt", TMP / "cookies.txt")
+main.COOKIES_PATH = TMP / "cookies.txt"
+
+KINDS = ("youtube", "tiktok", "other")
+
+
+def fresh_per_job(kind: str) -> None:
+    # اللي كان بيصير قبل: options + YoutubeDL جديد + cookies + close
+    opts = main.build_ydl_opts(kind)
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.cookiejar  # noqa: B018
+        ydl.params["format"] = "bv*+ba/best"
+
+
+def pooled(pool: YdlPool, kind: str) -> None:
+    with pool.lease(kind) as lease:
+        lease.override(format="bv*+ba/best", max_filesize=50 * 1024 * 1024)
+
+
+def check_shared_jar(pool: YdlPool) -> None:
+    # الـ request handlers لازم يستعملوا نفس الـ jar يلي بتقرا منه الـ extractors
+    for kind in KINDS:
+        with pool.lease(kind) as lease:
+            handlers = lease.ydl._request_director.handlers.values()
+            assert lease.ydl.cookiejar is pool._cookiejar, kind
+            assert all(rh.cookiejar is pool._cookiejar for rh in handlers), f"{kind}: handler has its own cookie jar"
+
+
+def measure(fn, iterations: int) -> list[float]:
+    samples = []
+    for i in range(iterations):
+        kind = KINDS[i % len(KINDS)]
+        t0 = time.perf_counter()
+        fn(kind)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def report(name: str, samples: list[float]) -> None:
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<22} mean={statistics.mean(samples):8.3f}ms  p50={statistics.median(samples):8.3f}ms  p95={p95:8.3f}ms")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+
+    # أول YoutubeDL بيحمّل الـ extractors (مرة وحدة بالـ process) — برّا القياس
+    fresh_per_job("other")
+
+    before = measure(fresh_per_job, iterations)
+
+    pool = YdlPool(main.build_ydl_opts, sizes={kind: 1 for kind in KINDS}, watch_files=[main.COOKIES_PATH])
+    t0 = time.perf_counter()
+    pool.warm()
+    warm_ms = (time.perf_counter() - t0) * 1000
+    check_shared_jar(pool)
+    after = measure(lambda kind: pooled(pool, kind), iterations)
+
+    print(f"iterations={iterations} cookies={main.COOKIES_PATH.exists()}")
+    report("fresh YoutubeDL/job", before)
+    report("pooled lease", after)
+    print(f"pool warm-up (one-off)  {warm_ms:8.3f}ms for {sum(pool.sizes.values())} instances")
+    print(f"speedup (mean)          {statistics.mean(before) / statistics.mean(after):8.1f}x")
+    shutil.rmtree(TMP, ignore_errors=True)
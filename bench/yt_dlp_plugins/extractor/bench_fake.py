@@ -0,0 +1,38 @@
+# Stub extractor for bench/loadtest.py — yt-dlp loads it as a plugin when
+# bench/ is on PYTHONPATH. Only matches https://bench.invalid/v/<id>?size=&latency=
+import os
+import time
+import urllib.parse
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchFakeIE(InfoExtractor):
+    IE_NAME = "benchfake"
+    _VALID_URL = r"https?://bench\.invalid/v/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        size = int(query.get("size", ["1048576"])[0])
+        latency = float(query.get("latency", ["0"])[0])
+
+        # latency تبع الـ extraction (متل request لصفحة الفيديو)
+        if latency:
+            time.sleep(latency)
+
+        media_url = os.environ["BENCH_MEDIA_URL"].rstrip("/")
+        return {
+            "id": video_id,
+            "title": f"bench {video_id}",
+            "duration": 10,
+            "formats": [{
+                "format_id": "synthetic",
+                "url": f"{media_url}/{size}?id={video_id}",
+                "ext": "mp4",
+                "vcodec": "avc1",
+                "acodec": "mp4a",
+                "height": 360,
+                "filesize": size,
+            }],
+        }
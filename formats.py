@@ -0,0 +1,143 @@
+import logging
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger("telegram_bot.formats")
+
+# الدمج بـ mp4 بيزيد شوي على مجموع الـ streams
+CONTAINER_OVERHEAD = 1.03
+
+
+class TooLarge(Exception):
+    """Even the smallest deliverable format is above the upload budget."""
+
+    def __init__(self, estimated: int, budget: int):
+        super().__init__(f"estimated {estimated} bytes > budget {budget} bytes")
+        self.estimated = estimated
+        self.budget = budget
+
+
+def estimate_size(fmt: dict, duration: float | None) -> int | None:
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    # tbr بالـ kbit/s
+    tbr = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+# codec مش معروف (None) = متل yt-dlp منعتبره فيه صوت وصورة
+def _has_video(fmt: dict) -> bool:
+    return fmt.get("vcodec") != "none"
+
+def _has_audio(fmt: dict) -> bool:
+    return fmt.get("acodec") != "none"
+
+def _rank(*fmts: dict) -> tuple:
+    video = fmts[0]
+    return (
+        video.get("height") or 0,
+        video.get("fps") or 0,
+        sum((f.get("tbr") or 0) for f in fmts),
+    )
+
+def pick_format(info: dict, budget: int, reencode_max: int = 0) -> tuple[str, int] | None:
+    """
+    Best video+audio combination whose estimated size fits `budget`.
+
+    Returns (format_spec, estimated_bytes), or None to let yt-dlp choose when
+    nothing sized fits but some format has no size information, or the
+    smallest candidate is within `reencode_max` (0 = no re-encoding). Raises
+    TooLarge otherwise.
+    """
+    duration = info.get("duration")
+    formats = [f for f in (info.get("formats") or [info]) if f.get("format_id") and f.get("ext") != "mhtml"]
+
+    combined, video_only, audio_only = [], [], []
+    unsized = False
+    for f in formats:
+        size = estimate_size(f, duration)
+        if size is None:
+            unsized = True
+            continue
+        if _has_video(f) and _has_audio(f):
+            combined.append((f, size))
+        elif _has_video(f):
+            video_only.append((f, size))
+        elif _has_audio(f):
+            audio_only.append((f, size))
+
+    candidates = [(_rank(f), f["format_id"], size) for f, size in combined]
+    for v, v_size in video_only:
+        for a, a_size in audio_only:
+            candidates.append((_rank(v, a), f"{v['format_id']}+{a['format_id']}", v_size + a_size))
+
+    if not candidates:
+        return None
+
+    fitting = [c for c in candidates if c[2] * CONTAINER_OVERHEAD <= budget]
+    if not fitting:
+        smallest = min(c[2] for c in candidates)
+        # صيغة بلا حجم ممكن توسع (size_guard بيوقفها إذا لا)، أو منعيد الترميز
+        if unsized or (reencode_max and smallest * CONTAINER_OVERHEAD <= reencode_max):
+            return None
+        raise TooLarge(smallest, budget)
+
+    _, spec, size = max(fitting, key=lambda c: (c[0], -c[2]))
+    return spec, size
+
+
+def size_guard(budget: int):
+    """
+    yt-dlp progress hook that aborts the download once the streams written so
+    far pass `budget`. Unlike max_filesize this also holds for fragmented
+    (DASH/HLS) downloads and for formats with no size information.
+    """
+    written: dict[str, int] = {}
+
+    def hook(d: dict) -> None:
+        if d.get("status") != "downloading":
+            return
+        # video و audio بينزلوا كل واحد لحاله، منجمعهن
+        written[d.get("filename") or ""] = max(d.get("downloaded_bytes") or 0, d.get("total_bytes") or 0)
+        total = sum(written.values())
+        if total > budget:
+            raise TooLarge(total, budget)
+
+    return hook
+
+def unwrap_too_large(exc: BaseException) -> TooLarge | None:
+    # yt-dlp بيلف الـ exceptions تبع الـ hooks بـ DownloadError (exc_info)
+    if isinstance(exc, TooLarge):
+        return exc
+    cause = getattr(exc, "exc_info", None)
+    if cause and isinstance(cause[1], TooLarge):
+        return cause[1]
+    return None
+
+
+def reencode_to_budget(src: Path, duration: float, budget: int, ffmpeg_exe: str) -> Path:
+    """Single-pass ffmpeg re-encode aimed at `budget` bytes (for formats with no size info)."""
+    audio_kbps = 96
+    total_kbps = int(budget * 8 / 1000 / duration * 0.92)
+    video_kbps = total_kbps - audio_kbps
+    if video_kbps < 100:
+        raise TooLarge(src.stat().st_size, budget)
+
+    dst = src.with_name(f"{src.stem}.small.mp4")
+    cmd = [
+        ffmpeg_exe, "-y", "-loglevel", "error", "-i", str(src),
+        "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+        "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+        "-movflags", "+faststart",
+        str(dst),
+    ]
+    logger.info(f"🎞️ re-encoding {src.name} -> {video_kbps}k video to fit {budget} bytes")
+    subprocess.run(cmd, check=True)
+    src.unlink(missing_ok=True)
+
+    if dst.stat().st_size > budget:
+        raise TooLarge(dst.stat().st_size, budget)
+    return dst
@@ -0,0 +1,243 @@
+import os
+import re
+import fcntl
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+from pathlib import Path
+from threading import Lock
+
+logger = logging.getLogger("telegram_bot.janitor")
+
+# اسم الملف النهائي بعد ما ينبعت (حتى نعرف شو منرجع نبعت بدون تحميل)
+DONE_MARKER = ".done"
+# flock عليه = المجلد مستعمل (بيشتغل بين كذا worker process عنفس الـ DOWNLOAD_DIR)
+LOCK_FILE = ".lock"
+_SEP = "--"
+# الـ sweep بيغيّر اسم المجلد لهيك قبل ما يمسحه (ما عاد حدا بيلاقيه)
+_EVICTING = ".evicting-"
+
+
+def _slug(key: str | None) -> str:
+    return re.sub(r"[^\w.-]+", "_", key or "job")[:120]
+
+def _entry_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+def _lock_dir(path: Path, op: int) -> int | None:
+    # بيرجع fd ماسك الـ flock، أو None إذا المجلد انمسح / مقفول (LOCK_NB)
+    lock_path = path / LOCK_FILE
+    try:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    try:
+        fcntl.flock(fd, op)
+        # sweep تبع process تاني ممكن يكون مسح المجلد وإحنا مستنيين القفل
+        if os.fstat(fd).st_ino != os.stat(lock_path).st_ino:
+            raise FileNotFoundError(lock_path)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DownloadJanitor:
+    """
+    One working directory per job under `root`, plus a background sweep that
+    keeps the total under `max_bytes` (least recently used first) and drops
+    anything older than `max_age` seconds. Directories in use are pinned,
+    in-process and with a shared flock on their LOCK_FILE, so several
+    processes can share one root: a sweep only deletes a directory it can
+    lock exclusively.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, max_age: float):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self._lock = Lock()
+        self._pinned: dict[Path, int] = {}
+        self._fds: dict[Path, int] = {}
+
+        self.disk_bytes = 0
+        self.entries = 0
+        self.evicted_entries = 0
+        self.evicted_bytes = 0
+        self.warm_hits = 0
+
+    # -------- per job --------
+    def acquire(self, key: str | None) -> Path:
+        while True:
+            path = self.root / f"{_slug(key)}{_SEP}{uuid.uuid4().hex[:8]}"
+            # pin قبل الـ mkdir: الـ sweep ما لازم يشوف المجلد فاضي وبلا pin
+            self._pin(path)
+            try:
+                path.mkdir(parents=True)
+                locked = self._lock_file(path)
+            except BaseException:
+                self._unpin(path)
+                raise
+            if locked:
+                return path
+            # sweep تبع process تاني مسحه قبل ما نلحق نقفله -> اسم جديد
+            self._unpin(path)
+
+    def find_warm(self, key: str | None) -> tuple[Path, Path] | None:
+        if not key:
+            return None
+        slug = _slug(key)
+        candidates = [p for p in self.root.glob(f"{slug}{_SEP}*") if p.name.rsplit(_SEP, 1)[0] == slug]
+        for job_dir in sorted(candidates, key=lambda p: p.stat().st_mtime, reverse=True):
+            marker = job_dir / DONE_MARKER
+            if not marker.exists():
+                continue
+            media = job_dir / marker.read_text().strip()
+            # check + pin تحت نفس الـ lock تبع الـ sweep
+            with self._lock:
+                if not media.is_file():
+                    continue
+                refs = self._pinned.get(job_dir, 0)
+                self._pinned[job_dir] = refs + 1
+            if not refs and not self._lock_file(job_dir):
+                self._unpin(job_dir)
+                continue
+            self.warm_hits += 1
+            return job_dir, media
+        return None
+
+    def clean_intermediates(self, job_dir: Path, keep: Path) -> None:
+        # بعد الدمج: ما منخلّي غير الملف النهائي (.part / .ytdl / .fNNN)
+        for p in job_dir.iterdir():
+            if p != keep and p.name not in (DONE_MARKER, LOCK_FILE):
+                if p.is_dir():
+                    shutil.rmtree(p, ignore_errors=True)
+                else:
+                    p.unlink(missing_ok=True)
+
+    def share(self, job_dir: Path) -> bool:
+        """One more pin on a directory another job in this process still holds (False if released)."""
+        with self._lock:
+            if job_dir not in self._pinned:
+                return False
+            self._pinned[job_dir] += 1
+        return True
+
+    def release(self, job_dir: Path, media: Path | None = None) -> None:
+        """Unpin; keep the directory warm when `media` was delivered, delete it otherwise (once unshared)."""
+        if media is not None and media.is_file():
+            try:
+                (job_dir / DONE_MARKER).write_text(media.name)
+                now = time.time()
+                os.utime(job_dir, (now, now))
+            except OSError as e:
+                # الديسك مليان مثلاً: الملف وصل، بس ما منقدر نخلّيه warm -> منمسحه
+                logger.warning(f"⚠️ can't keep {job_dir.name} warm: {e}")
+            else:
+                self._unpin(job_dir)
+                return
+        if self._unpin(job_dir):
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    # -------- sweep --------
+    def sweep(self) -> int:
+        now = time.time()
+        items = []
+        for entry in self.root.iterdir():
+            try:
+                items.append((entry.stat().st_mtime, entry, _entry_size(entry)))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, _, size in items)
+        removed = 0
+        # الأقدم أولاً (LRU — mtime بيتحدّث مع كل إرسال)
+        for mtime, entry, size in sorted(items, key=lambda i: i[0]):
+            too_old = self.max_age > 0 and now - mtime > self.max_age
+            over_budget = self.max_bytes > 0 and total > self.max_bytes
+            if not (too_old or over_budget):
+                continue
+            fd = None
+            with self._lock:
+                if entry in self._pinned:
+                    continue
+                if entry.is_dir():
+                    # process تاني عم يستعمله؟ (shared flock) -> منتركه
+                    fd = _lock_dir(entry, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if fd is None:
+                        continue
+                    # منغيّر اسمه تحت الـ lock (find_warm ما عاد بيلاقيه)، والمسح البطيء برّا الـ lock
+                    doomed = self.root / f"{_EVICTING}{uuid.uuid4().hex[:8]}"
+                    try:
+                        entry.rename(doomed)
+                    except OSError:
+                        os.close(fd)
+                        continue
+                else:
+                    entry.unlink(missing_ok=True)
+            if fd is not None:
+                try:
+                    shutil.rmtree(doomed, ignore_errors=True)
+                finally:
+                    os.close(fd)
+            total -= size
+            removed += 1
+            self.evicted_entries += 1
+            self.evicted_bytes += size
+
+        self.disk_bytes = total
+        self.entries = len(items) - removed
+        if removed:
+            logger.info(f"🧹 evicted {removed} download entries, now {total / 1024 / 1024:.1f}MB in {self.entries}")
+        return removed
+
+    async def run(self, interval: float) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception:
+                logger.exception("❌ janitor sweep failed")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {
+            "disk_bytes": self.disk_bytes,
+            "max_bytes": self.max_bytes,
+            "entries": self.entries,
+            "pinned": len(self._pinned),
+            "evicted_entries": self.evicted_entries,
+            "evicted_bytes": self.evicted_bytes,
+            "warm_hits": self.warm_hits,
+        }
+
+    # -------- internals --------
+    def _pin(self, path: Path) -> None:
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+
+    def _lock_file(self, path: Path) -> bool:
+        fd = _lock_dir(path, fcntl.LOCK_SH)
+        if fd is None:
+            return False
+        with self._lock:
+            self._fds[path] = fd
+        return True
+
+    def _unpin(self, path: Path) -> bool:
+        # True = هاد كان آخر pin
+        with self._lock:
+            refs = self._pinned.get(path, 0) - 1
+            if refs > 0:
+                self._pinned[path] = refs
+                return False
+            self._pinned.pop(path, None)
+            fd = self._fds.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+            return True
@@ -0,0 +1,395 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from threading import Lock
+
+from scheduler import QueueFull
+
+logger = logging.getLogger("telegram_bot.jobqueue")
+
+
+class LeasedJob:
+    def __init__(
+        self, job_id: int, kind: str, user_id: int, payload: dict, attempts: int, token: str, checkpoint: dict | None = None,
+    ):
+        self.id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.payload = payload
+        self.attempts = attempts
+        self.token = token
+        # شو انبعت من قبل بمحاولة سابقة (حتى ما نبعته مرة تانية)
+        self.checkpoint = checkpoint or {}
+        # بيصير True إذا worker تاني أخد الـ lease (منوقف بدون ما نسلّم)
+        self.lost = False
+
+
+class JobQueue(ABC):
+    """
+    Durable queue between the webhook front end and download workers.
+
+    A leased job belongs to one worker until its lease expires; the worker
+    keeps it alive with heartbeat(). complete() and release() are fenced on
+    the lease token, so a worker that lost its lease cannot overwrite the
+    result of the worker that took over. Jobs whose worker died are leased
+    again once the lease runs out, with `attempts` incremented.
+
+    Delivery is at-least-once. A worker records what it already delivered with
+    checkpoint() right after each send, and a retry skips those parts, so a
+    duplicate only happens when a worker dies between a send and its checkpoint.
+
+    A shared-store backend (e.g. Postgres with SELECT … FOR UPDATE SKIP
+    LOCKED) subclasses this and registers its URL scheme with
+    register_backend(), so JOB_QUEUE_URL can select it.
+    """
+
+    @abstractmethod
+    def enqueue(self, kind: str, user_id: int, payload: dict) -> int:
+        ...
+
+    @abstractmethod
+    def lease(self, owner: str, lease_seconds: float) -> LeasedJob | None:
+        ...
+
+    @abstractmethod
+    def heartbeat(self, job_id: int, token: str, lease_seconds: float) -> bool:
+        ...
+
+    @abstractmethod
+    def complete(self, job_id: int, token: str, result: dict) -> bool:
+        ...
+
+    @abstractmethod
+    def release(self, job_id: int, token: str) -> bool:
+        """Hand a job back without counting the attempt (graceful worker shutdown)."""
+
+    @abstractmethod
+    def checkpoint(self, job_id: int, token: str, data: dict) -> bool:
+        """Persist progress (what was delivered) for a retry to pick up."""
+
+    @abstractmethod
+    def result(self, job_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    def purge(self, older_than: float) -> int:
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    JobQueue in a SQLite file (WAL). Safe for any number of processes on one
+    machine; don't put the file on a network share.
+    """
+
+    def __init__(self, path: Path, max_queued: int = 0, max_per_user: int = 0):
+        self.path = Path(path)
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.enqueued = 0
+        self.leased = 0
+        self.expired = 0
+
+        self._lock = Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " user_id INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'queued',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT,"
+            " lease_token TEXT,"
+            " lease_expires_at REAL,"
+            " result TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "checkpoint" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN checkpoint TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, lease_expires_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs(user_id, state)")
+
+    def enqueue(self, kind: str, user_id: int, payload: dict) -> int:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE: فحص الحدود + الإضافة بخطوة وحدة بين كل الـ processes
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.max_queued > 0:
+                    (queued,) = self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()
+                    if queued >= self.max_queued:
+                        raise QueueFull("queue")
+                if self.max_per_user > 0:
+                    (mine,) = self._db.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND user_id = ?", (user_id,)
+                    ).fetchone()
+                    if mine >= self.max_per_user:
+                        raise QueueFull("user")
+                cur = self._db.execute(
+                    "INSERT INTO jobs (kind, user_id, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (kind, user_id, json.dumps(payload), now, now),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        self.enqueued += 1
+        return cur.lastrowid
+
+    def lease(self, owner: str, lease_seconds: float) -> LeasedJob | None:
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # أقدم job بالدور، أو job الـ worker تبعها مات (الـ lease خلص)
+                row = self._db.execute(
+                    "SELECT id, kind, user_id, payload, attempts, state, checkpoint FROM jobs"
+                    " WHERE state = 'queued' OR (state = 'running' AND lease_expires_at < ?)"
+                    " ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row:
+                    self._db.execute(
+                        "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?,"
+                        " lease_token = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                        (owner, token, now + lease_seconds, now, row[0]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        job_id, kind, user_id, payload, attempts, state, checkpoint = row
+        self.leased += 1
+        if state == "running":
+            self.expired += 1
+            logger.warning(f"♻️ job #{job_id} lease expired, retrying (attempt {attempts + 1})")
+        return LeasedJob(
+            job_id, kind, user_id, json.loads(payload), attempts + 1, token, json.loads(checkpoint) if checkpoint else None,
+        )
+
+    def heartbeat(self, job_id: int, token: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ?"
+                " WHERE id = ? AND lease_token = ? AND state = 'running'",
+                (now + lease_seconds, now, job_id, token),
+            )
+        return cur.rowcount == 1
+
+    def complete(self, job_id: int, token: str, result: dict) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE jobs SET state = 'done', result = ?, lease_token = NULL, lease_expires_at = NULL,"
+                " updated_at = ? WHERE id = ? AND lease_token = ? AND state = 'running'",
+                (json.dumps(result), time.time(), job_id, token),
+            )
+        return cur.rowcount == 1
+
+    def release(self, job_id: int, token: str) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE jobs SET state = 'queued', attempts = attempts - 1, lease_owner = NULL,"
+                " lease_token = NULL, lease_expires_at = NULL, updated_at = ?"
+                " WHERE id = ? AND lease_token = ? AND state = 'running'",
+                (time.time(), job_id, token),
+            )
+        return cur.rowcount == 1
+
+    def checkpoint(self, job_id: int, token: str, data: dict) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ? AND lease_token = ? AND state = 'running'",
+                (json.dumps(data), time.time(), job_id, token),
+            )
+        return cur.rowcount == 1
+
+    def result(self, job_id: int) -> dict | None:
+        with self._lock:
+            row = self._db.execute("SELECT result FROM jobs WHERE id = ? AND state = 'done'", (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            cur = self._db.execute(
+                "DELETE FROM jobs WHERE state = 'done' AND updated_at < ?", (time.time() - older_than,)
+            )
+        if cur.rowcount:
+            logger.info(f"🧹 purged {cur.rowcount} finished jobs")
+        return cur.rowcount
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            (oldest,) = self._db.execute("SELECT MIN(created_at) FROM jobs WHERE state = 'queued'").fetchone()
+            (retried,) = self._db.execute("SELECT COUNT(*) FROM jobs WHERE attempts > 1").fetchone()
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "retried": retried,
+            "oldest_queued_age": round(now - oldest, 3) if oldest else 0.0,
+            "enqueued": self.enqueued,
+            "leased": self.leased,
+            "expired": self.expired,
+        }
+
+
+class JobWorker:
+    """
+    Leases jobs from a JobQueue and runs `handle(job)` for each, at most
+    `concurrency` at a time, keeping every lease alive with heartbeats.
+
+    handle() returns the job result. An exception is logged and recorded as
+    {"outcome": "error"}: the job is finished, not retried, because parts of
+    it may already have been delivered. Only a crashed worker (lease expiry)
+    causes a retry. On a lost lease the job task is cancelled and `on_lost`
+    is called first so shielded work can be stopped too. On stop, running
+    jobs get `drain_timeout` seconds; the rest are released back to the queue.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        owner: str,
+        handle: Callable[[LeasedJob], Awaitable[dict]],
+        concurrency: int,
+        lease_seconds: float,
+        poll_interval: float,
+        drain_timeout: float,
+        retention: float = 0,
+        on_lost: Callable[[LeasedJob], None] | None = None,
+        on_drain_timeout: Callable[[], None] | None = None,
+    ):
+        self.queue = queue
+        self.owner = owner
+        self.handle = handle
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+        self.retention = retention
+        self.on_lost = on_lost
+        self.on_drain_timeout = on_drain_timeout
+
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+        self.released = 0
+
+    async def run(self, stop: asyncio.Event) -> None:
+        running: set[asyncio.Task] = set()
+        stopping = asyncio.ensure_future(stop.wait())
+        last_purge = 0.0
+
+        while not stop.is_set():
+            # ما منستلم jobs أكتر من يلي منقدر نشغّل
+            if len(running) >= self.concurrency:
+                await asyncio.wait({stopping, *running}, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            if self.retention and time.monotonic() - last_purge > 3600:
+                last_purge = time.monotonic()
+                await asyncio.to_thread(self.queue.purge, self.retention)
+
+            job = await asyncio.to_thread(self.queue.lease, self.owner, self.lease_seconds)
+            if job is None:
+                await asyncio.wait({stopping}, timeout=self.poll_interval)
+                continue
+
+            task = asyncio.create_task(self._run_job(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        # Graceful drain: منكمّل يلي بإيدنا، والباقي بيرجع للـ queue
+        logger.info(f"🛑 worker draining {len(running)} jobs…")
+        if running:
+            _, pending = await asyncio.wait(running, timeout=self.drain_timeout)
+            if pending and self.on_drain_timeout:
+                self.on_drain_timeout()
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"completed": self.completed, "failed": self.failed, "lost": self.lost, "released": self.released}
+
+    async def _heartbeat(self, job: LeasedJob, owner: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                alive = await asyncio.to_thread(self.queue.heartbeat, job.id, job.token, self.lease_seconds)
+            except Exception:
+                # الـ DB مشغولة؟ منجرّب بالدورة الجاية، الـ lease لسا إلنا
+                logger.exception(f"⚠️ heartbeat failed for job #{job.id}")
+                continue
+            if not alive:
+                logger.warning(f"⚠️ lost lease on job #{job.id}, stopping it")
+                job.lost = True
+                self.lost += 1
+                if self.on_lost:
+                    self.on_lost(job)
+                owner.cancel()
+                return
+
+    async def _run_job(self, job: LeasedJob) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job, asyncio.current_task()))
+        try:
+            result = await self.handle(job)
+        except asyncio.CancelledError:
+            if not job.lost:
+                # shutdown: منرجّع الـ job للـ queue لـ worker تاني
+                await asyncio.to_thread(self.queue.release, job.id, job.token)
+                self.released += 1
+                logger.info(f"↩️ job #{job.id} handed back to the queue")
+            raise
+        except Exception:
+            logger.exception(f"❌ job #{job.id} failed:")
+            self.failed += 1
+            result = {"outcome": "error"}
+        finally:
+            heartbeat.cancel()
+
+        if await asyncio.to_thread(self.queue.complete, job.id, job.token, result):
+            self.completed += 1
+        else:
+            logger.warning(f"⚠️ job #{job.id} finished after its lease was taken over (possible duplicate delivery)")
+
+
+# scheme تبع JOB_QUEUE_URL -> factory(باقي الـ URL، max_queued=…, max_per_user=…)
+_BACKENDS: dict[str, Callable[..., JobQueue]] = {}
+
+def register_backend(scheme: str, factory: Callable[..., JobQueue]) -> None:
+    _BACKENDS[scheme] = factory
+
+register_backend("sqlite", lambda rest, **kwargs: SqliteJobQueue(Path(rest), **kwargs))
+
+def open_job_queue(url: str, **kwargs) -> JobQueue:
+    # "sqlite:///path/jobs.sqlite3" أو مسار عادي
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        scheme, rest = "sqlite", url
+    factory = _BACKENDS.get(scheme)
+    if factory is None:
+        raise ValueError(f"unsupported JOB_QUEUE_URL scheme: {scheme!r} (supported: {', '.join(sorted(_BACKENDS))})")
+    return factory(rest, **kwargs)
@@ -1,17 +1,41 @@
 import os
 import re
+import sys
+import time
+import hmac
+import json
+import signal
+import socket
 import logging
 import asyncio
 import random
+import contextlib
+import contextvars
 from pathlib import Path
-from threading import Thread
 
-from flask import Flask, request, abort
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
 
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram import InputMediaDocument, Message, Update
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, SimpleUpdateProcessor, filters
 
-import yt_dlp
+from telegram.error import BadRequest, RetryAfter
+
+from media_cache import MediaCache, canonical_key_from_url, canonical_key_from_info
+from singleflight import SingleFlight
+from scheduler import DownloadScheduler, QueueFull, parse_caps
+from formats import TooLarge, pick_format, reencode_to_budget, size_guard, unwrap_too_large
+from ydl_pool import YdlPool
+from janitor import DONE_MARKER, LOCK_FILE, DownloadJanitor
+from outbound import OutboundRateLimiter, StatusMessage
+from jobqueue import JobWorker, LeasedJob, open_job_queue
+from batch import MEDIA_GROUP_SIZE, BatchProgress, extract_urls, flat_entry_urls, is_collection_url
+from metrics import (
+    EVICTED_BYTES, EVICTED_ENTRIES, GAUGES, JOB_SECONDS, JOBS_TOTAL, LEASES_EXPIRED, MEDIA_CACHE_HITS,
+    MEDIA_CACHE_MISSES, QUEUE_REJECTED, STAGE_SECONDS, TELEGRAM_REQUESTS, TELEGRAM_RETRY_AFTER,
+    TELEGRAM_WAIT_SECONDS, WARM_HITS,
+    DownloadTracker, TraceIdFilter, new_trace_id, registry, span, trace_id_var,
+)
 
 # ✅ ffmpeg portable (بدون apt / بدون بروكسي / مجاني)
 import imageio_ffmpeg
@@ -22,52 +46,185 @@ import imageio_ffmpeg
 # =========================
 PORT = int(os.getenv("PORT", "10000"))
 
+# all = webhook + تحميل بنفس الـ process (الافتراضي)
+# web = webhook بس، بيحط الروابط بالـ job queue
+# worker = بياخد jobs من الـ queue وبيحمّل وبيرسل (python main.py worker)
+RUN_MODE = os.getenv("RUN_MODE", "all")
+# الـ argument بس إذا main.py هو الـ script (bench/ydl_setup.py بيعمل import main مع arguments تبعه)
+if __name__ == "__main__" and len(sys.argv) > 1:
+    RUN_MODE = sys.argv[1]
+RUN_MODE = RUN_MODE.strip().lower()
+if RUN_MODE not in ("all", "web", "worker"):
+    raise RuntimeError(f"RUN_MODE لازم يكون all أو web أو worker (مش {RUN_MODE!r}).")
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # https://telegram-bot-85nr.onrender.com
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")    # سر لمسار الويبهوك
-PROXY_URL = (os.getenv("PROXY_URL") or "").strip()  # اختياري (TikTok/YouTube)
+# اختياري: Bot API server تاني (local telegram-bot-api أو الـ fake تبع bench/loadtest.py)
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "").strip().rstrip("/")
+
+# كم update منعالج بنفس الوقت، وكم منقبل قبل ما نرجّع 503 (تيليغرام بيعيد المحاولة)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "256"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+
+# حدود تيليغرام للرسائل: ~30/ثانية بالمجمل، ~1/ثانية لكل chat، 20/دقيقة لكل group
+TG_GLOBAL_PER_SECOND = float(os.getenv("TG_GLOBAL_PER_SECOND", "30"))
+TG_CHAT_PER_SECOND = float(os.getenv("TG_CHAT_PER_SECOND", "1"))
+TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+# كل كم % منحدّث رسالة التقدّم (0 = بلا تقدّم)
+PROGRESS_STEP = int(os.getenv("PROGRESS_STEP", "10"))
 
 TIKTOK_DEVICE_ID = (os.getenv("TIKTOK_DEVICE_ID") or "").strip()
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN غير موجود في Render Environment.")
-if not WEBHOOK_URL:
-    raise RuntimeError("WEBHOOK_URL غير موجود في Render Environment.")
-if not WEBHOOK_SECRET:
-    raise RuntimeError("WEBHOOK_SECRET غير موجود في Render Environment.")
+if RUN_MODE != "worker":
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL غير موجود في Render Environment.")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET غير موجود في Render Environment.")
+
+# تيليغرام بيقبل secret_token بس من هالأحرف؛ إذا السر غير هيك منكتفي بالمسار
+WEBHOOK_HEADER_TOKEN = (
+    WEBHOOK_SECRET if WEBHOOK_SECRET and re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET) else None
+)
 
 # =========================
 # Paths
 # =========================
 BASE_DIR = Path(__file__).resolve().parent
-DOWNLOAD_DIR = BASE_DIR / "downloads"
+DOWNLOAD_DIR = Path(os.getenv("DOWNLOAD_DIR") or (BASE_DIR / "downloads"))
 DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# الديسك على Render صغير: سقف للحجم + عمر أقصى للملفات المبعوتة (منخليها warm لإعادة الإرسال)
+DOWNLOAD_DIR_MAX_BYTES = int(float(os.getenv("DOWNLOAD_DIR_MAX_MB", "1024")) * 1024 * 1024)
+DOWNLOAD_MAX_AGE = float(os.getenv("DOWNLOAD_MAX_AGE", str(6 * 3600)))
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "60"))
+
 # cookies.txt (Secret File على Render)
 COOKIES_PATH = BASE_DIR / "cookies.txt"
+# proxy.txt (Secret File، سطر واحد) بيتقرا من جديد إذا تغيّر؛ PROXY_URL بالـ env بيلزمه restart
+PROXY_PATH = Path(os.getenv("PROXY_FILE") or (BASE_DIR / "proxy.txt"))
 
 # ffmpeg exe path (portable)
 FFMPEG_EXE = imageio_ffmpeg.get_ffmpeg_exe()
 
+# كاش file_id تبع تيليغرام (بيضل بعد الـ restart)
+MEDIA_CACHE_PATH = Path(os.getenv("MEDIA_CACHE_PATH") or (BASE_DIR / "media_cache.sqlite3"))
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", str(7 * 24 * 3600)))   # ثواني، 0 = بلا انتهاء
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "5000"))
+
+# Scheduler: كم تحميل بنفس الوقت، ولكل منصة لحالها
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_CAPS = parse_caps(os.getenv("DOWNLOAD_CAPS", "youtube=2,tiktok=2,other=2"))
+DOWNLOAD_QUEUE_MAX = int(os.getenv("DOWNLOAD_QUEUE_MAX", "100"))
+DOWNLOAD_QUEUE_PER_USER = int(os.getenv("DOWNLOAD_QUEUE_PER_USER", "3"))
+QUEUE_POSITION_INTERVAL = float(os.getenv("QUEUE_POSITION_INTERVAL", "3"))
+
+# Batch: كذا رابط بنفس الرسالة، أو playlist / بروفايل TikTok
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))          # أقصى عدد فيديوهات بالرسالة (بعد الـ expand)
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "10"))    # 0 = ما منفتح playlists/بروفايلات
+# كم item من نفس الـ batch بالـ scheduler سوا (الحد تبع المستخدم بيرفض أكتر من هيك)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(DOWNLOAD_QUEUE_PER_USER)))
+
+# Job queue بين الـ webhook والـ workers (RUN_MODE=web/worker)
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL") or str(BASE_DIR / "jobs.sqlite3")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "30"))       # heartbeat كل تلت هالمدة
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))           # بعدها منبلّغ المستخدم بالفشل
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(24 * 3600)))    # jobs الخالصة منمسحها بعد هالمدة
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# الـ worker ما بيسمع على PORT؛ إذا بدك /stats و /metrics إله حط WORKER_PORT
+WORKER_PORT = int(os.getenv("WORKER_PORT", "0"))
+
+# حد رفع الملفات تبع تيليغرام للبوتات (50MB على الـ cloud API)
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+# إذا ما في حجم معروف للصيغ: ننزل ونصغّر بـ ffmpeg (أبطأ وبياكل CPU)
+REENCODE_FALLBACK = os.getenv("REENCODE_FALLBACK", "0") == "1"
+REENCODE_MAX_SOURCE_BYTES = MAX_UPLOAD_BYTES * int(os.getenv("REENCODE_MAX_SOURCE_RATIO", "4"))
+
 
 # =========================
 # Logging
 # =========================
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s",
 )
+# trace id لكل رسالة (بيمشي مع الـ contextvars لحد threads تبع التحميل)
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceIdFilter())
 logger = logging.getLogger("telegram_bot")
 
 
 # =========================
-# Flask app + Telegram app
+# Telegram app
 # =========================
-app = Flask(__name__)
-application = Application.builder().token(BOT_TOKEN).build()
+class TrackedUpdateProcessor(SimpleUpdateProcessor):
+    """Counts updates accepted by the webhook until their handler finishes."""
+
+    __slots__ = ("pending",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.pending = 0
+
+    async def do_process_update(self, update, coroutine) -> None:
+        try:
+            await coroutine
+        finally:
+            self.pending -= 1
+
+update_processor = TrackedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+rate_limiter = OutboundRateLimiter(
+    overall_per_second=TG_GLOBAL_PER_SECOND,
+    chat_per_second=TG_CHAT_PER_SECOND,
+    group_per_minute=TG_GROUP_PER_MINUTE,
+)
+_builder = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .concurrent_updates(update_processor)
+    .rate_limiter(rate_limiter)
+)
+if TELEGRAM_API_URL:
+    _builder = _builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+application = _builder.build()
+media_cache = MediaCache(MEDIA_CACHE_PATH, ttl=MEDIA_CACHE_TTL, max_entries=MEDIA_CACHE_MAX_ENTRIES)
 
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+# نفس الفيديو عم يتحمّل؟ الطلبات الجديدة بتستنى نفس الـ job
+downloads = SingleFlight()
+# الـ job يلي عم نشتغل عليه (RUN_MODE=worker)، والـ flights يلي عم يستنى عليهن (منوقفهن إذا راح الـ lease)
+current_job: contextvars.ContextVar[LeasedJob | None] = contextvars.ContextVar("current_job", default=None)
+job_flights: dict[int, set[str]] = {}
+# batch items يلي batch عم يقودهن: الملف بيوصل هون أول ما يخلص التحميل (قبل الـ upload)
+batch_handoffs: dict[str, asyncio.Future] = {}
+
+scheduler = DownloadScheduler(
+    workers=DOWNLOAD_WORKERS,
+    caps=DOWNLOAD_CAPS,
+    max_queue=DOWNLOAD_QUEUE_MAX,
+    max_per_user=DOWNLOAD_QUEUE_PER_USER,
+    on_start=lambda job: STAGE_SECONDS.observe(job.wait_time, stage="queue", kind=job.kind, outcome="ok"),
+)
+
+# instance لكل download slot، وبتنبنى من جديد إذا تغيّر cookies.txt أو proxy.txt
+ydl_pool = YdlPool(
+    build_opts=lambda kind: build_ydl_opts(kind),
+    sizes={kind: DOWNLOAD_CAPS.get(kind, DOWNLOAD_WORKERS) for kind in ("youtube", "tiktok", "other")},
+    watch_files=[COOKIES_PATH, PROXY_PATH],
+)
+
+janitor = DownloadJanitor(DOWNLOAD_DIR, max_bytes=DOWNLOAD_DIR_MAX_BYTES, max_age=DOWNLOAD_MAX_AGE)
+
+# بالـ RUN_MODE=all ما في queue، كل شي بالـ process نفسه
+job_queue = None
+if RUN_MODE != "all":
+    job_queue = open_job_queue(JOB_QUEUE_URL, max_queued=DOWNLOAD_QUEUE_MAX, max_per_user=DOWNLOAD_QUEUE_PER_USER)
+if RUN_MODE == "worker":
+    # الحدود بتنفحص وقت الـ enqueue؛ الـ worker ما بياخد أكتر من DOWNLOAD_WORKERS job
+    scheduler.max_per_user = scheduler.max_queue
 
 
 # =========================
@@ -136,11 +293,11 @@ def _get_device_id() -> str:
         return TIKTOK_DEVICE_ID
     return "".join(str(random.randint(0, 9)) for _ in range(19))
 
-def build_ydl_opts(url: str) -> dict:
-    kind = classify_url(url)
-
+def build_ydl_opts(kind: str) -> dict:
+    # profile لكل منصة؛ بيتبنى مرة وحدة بالـ pool (وبيرجع ينبنى إذا تغيّر cookies/proxy)
     opts = {
-        "outtmpl": str(DOWNLOAD_DIR / "%(title)s.%(ext)s"),
+        # كل job بياخد مجلد لحاله (janitor.acquire) وهاد بس default
+        "outtmpl": str(DOWNLOAD_DIR / "%(id)s.%(ext)s"),
 
         # ✅ خليها عامة وما تشدد على mp4 فقط
         # رح ننزل أفضل فيديو + أفضل صوت وبعدين ندمج
@@ -160,9 +317,13 @@ def build_ydl_opts(url: str) -> dict:
         "merge_output_format": "mp4",
     }
 
-    # Proxy اختياري
-    if PROXY_URL:
-        opts["proxy"] = PROXY_URL
+    # Proxy اختياري (TikTok/YouTube) — proxy.txt أول (بيتحدّث بدون restart)، وإلا PROXY_URL
+    proxy_url = ""
+    if PROXY_PATH.exists():
+        proxy_url = PROXY_PATH.read_text().strip()
+    proxy_url = proxy_url or (os.getenv("PROXY_URL") or "").strip()
+    if proxy_url:
+        opts["proxy"] = proxy_url
 
     # Cookies
     if COOKIES_PATH.exists():
@@ -194,14 +355,188 @@ def build_ydl_opts(url: str) -> dict:
 
     return opts
 
-async def run_yt_dlp_download(url: str) -> dict:
-    ydl_opts = build_ydl_opts(url)
+def progress_hook(status: StatusMessage, loop: asyncio.AbstractEventLoop):
+    # بيشتغل بـ thread تبع yt-dlp؛ StatusMessage بيدمج التحديثات فما منكتّر API calls
+    last = -PROGRESS_STEP
+
+    def hook(d: dict) -> None:
+        nonlocal last
+        if d.get("status") != "downloading":
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        if not total:
+            return
+        pct = int(d.get("downloaded_bytes", 0) * 100 / total)
+        if pct - last >= PROGRESS_STEP and pct < 100:
+            last = pct
+            loop.call_soon_threadsafe(status.set, f"⬇️ عم حمّل الفيديو… {pct}%")
+
+    return hook
+
+async def run_yt_dlp_download(url: str, user_id: int = 0, status: StatusMessage | None = None) -> dict:
+    kind = classify_url(url)
+    url_key = canonical_key_from_url(url)
+    hooks = [progress_hook(status, asyncio.get_running_loop())] if status and PROGRESS_STEP > 0 else []
 
     def _download():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=True)
+        with ydl_pool.lease(kind) as lease:
+            ydl = lease.ydl
+
+            # 1) metadata بس، بدون تحميل
+            with span("extract", kind):
+                info = ydl.extract_info(url, download=False)
+
+            # روابط قصيرة: المفتاح الحقيقي بيطلع بس من info -> يمكن يكون بالكاش
+            info_key = canonical_key_from_info(info)
+            if info_key and info_key != url_key:
+                entry = media_cache.get(info_key)
+                if entry:
+                    # المفتاح معه، حتى إذا الـ file_id طلع قديم منعرف شو منحذف
+                    info["_cached"] = {**entry, "key": info_key}
+                    return info
+
+            # الملف لسا على الديسك من إرسال قبل؟
+            key = info_key or url_key
+            warm = janitor.find_warm(key)
+            if warm:
+                logger.info(f"🔥 warm file for {key}: {warm[1].name}")
+                info["_job_dir"] = warm[0]
+                info["requested_downloads"] = [{"filepath": str(warm[1])}]
+                return info
+
+            # 2) أحسن صيغة بتوسع بحد تيليغرام (أو TooLarge من هلق)
+            choice = pick_format(info, MAX_UPLOAD_BYTES, REENCODE_MAX_SOURCE_BYTES if REENCODE_FALLBACK else 0)
+            reencode = choice is None and REENCODE_FALLBACK
+            if choice:
+                lease.override(format=choice[0])
+                logger.info(f"📏 format {choice[0]} ~{choice[1] / 1024 / 1024:.1f}MB for {url}")
+
+            job_dir = janitor.acquire(key)
+            try:
+                tracker = DownloadTracker(kind)
+                cap = REENCODE_MAX_SOURCE_BYTES if reencode else MAX_UPLOAD_BYTES
+                lease.override(
+                    outtmpl=str(job_dir / "%(id)s.%(ext)s"),
+                    max_filesize=cap,
+                    # max_filesize ما بيوقف الصيغ المقطّعة (DASH/HLS) ولا يلي بلا حجم -> منعدّ البايتات بنفسنا
+                    progress_hooks=[size_guard(cap), tracker.on_progress, *hooks],
+                    postprocessor_hooks=[tracker.on_postprocess],
+                )
+
+                # 3) التحميل من نفس الـ info (بدون extract مرة تانية)
+                # sanitize_info بيشيل اختيار الصيغة القديم (requested_formats…) متل --load-info-json
+                try:
+                    info = ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+                except Exception as e:
+                    too_large = unwrap_too_large(e)
+                    tracker.finish("too_large" if too_large else "error")
+                    if too_large:
+                        raise too_large from None
+                    raise
+                tracker.finish()
+                logger.info(f"📥 downloaded {tracker.bytes / 1024 / 1024:.1f}MB for {url}")
 
-    return await asyncio.to_thread(_download)
+                file_path = find_downloaded_file(info)
+                if not file_path and not any(p.name not in (DONE_MARKER, LOCK_FILE) for p in job_dir.iterdir()):
+                    # yt-dlp بيتخطّى الملف بصمت إذا أكبر من max_filesize
+                    raise TooLarge(info.get("filesize") or info.get("filesize_approx") or 0, cap)
+                if file_path and file_path.stat().st_size > MAX_UPLOAD_BYTES:
+                    if not (reencode and info.get("duration")):
+                        raise TooLarge(file_path.stat().st_size, MAX_UPLOAD_BYTES)
+                    with span("reencode", kind):
+                        file_path = reencode_to_budget(file_path, info["duration"], MAX_UPLOAD_BYTES, FFMPEG_EXE)
+                    info["requested_downloads"] = [{"filepath": str(file_path)}]
+                if file_path:
+                    janitor.clean_intermediates(job_dir, keep=file_path)
+            except BaseException:
+                janitor.release(job_dir)
+                raise
+
+        info["_job_dir"] = job_dir
+        return info
+
+    async def _show_position(job):
+        last = None
+        while not job.started.is_set():
+            pos = scheduler.position(job)
+            if pos and pos != last:
+                last = pos
+                status.set(f"⏳ طلبك بالدور… رقمك بالطابور: {pos}")
+            try:
+                await asyncio.wait_for(job.started.wait(), timeout=QUEUE_POSITION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        if last is not None:
+            status.set("⏳ عم حمّل الفيديو…")
+
+    return await scheduler.run(
+        kind, user_id, _download,
+        on_queued=_show_position if status is not None else None,
+    )
+
+async def send_cached(update: Update, status: StatusMessage, key: str, kind: str, entry: dict | None = None) -> bool:
+    entry = entry or media_cache.get(key)
+    if not entry:
+        return False
+
+    title = entry.get("title") or "video"
+    logger.info(f"♻️ cache hit {key} stats={media_cache.stats()}")
+    try:
+        with span("resend", kind):
+            await update.message.reply_document(document=entry["file_id"])
+    except BadRequest:
+        # file_id ما عاد صالح -> منحذفه ومننزل من جديد
+        logger.warning(f"⚠️ cached file_id rejected for {key}, re-downloading")
+        media_cache.invalidate(key)
+        return False
+    await status.update(f"✅ تم الإرسال بنجاح: {title}")
+    return True
+
+async def fetch_and_upload(url: str, key: str | None, update: Update, status: StatusMessage) -> dict:
+    user_id = update.effective_user.id if update.effective_user else 0
+    info = await run_yt_dlp_download(url, user_id=user_id, status=status)
+
+    entry = info.get("_cached")
+    if entry:
+        # رابط قصير لقيناه بالكاش عن طريق info: متل send_cached، file_id قديم -> منحذفه ومننزل من جديد
+        result = {"file_id": entry["file_id"], "title": entry.get("title") or "video", "cached": True}
+        if await send_cached(update, status, entry["key"], classify_url(url), entry=entry):
+            return {**result, "message": update.message}
+        info = await run_yt_dlp_download(url, user_id=user_id, status=status)
+        entry = info.get("_cached")
+        if entry:
+            # حدا تاني رجع حطّه بالكاش بهالوقت
+            return {"file_id": entry["file_id"], "title": entry.get("title") or "video", "message": None}
+    key = canonical_key_from_info(info) or key
+
+    title = safe_filename(info.get("title") or "video")
+    file_path = find_downloaded_file(info)
+    job_dir = info.get("_job_dir")
+    delivered = None
+    try:
+        if not file_path:
+            return {"file_id": None, "title": title, "message": None}
+
+        kind = classify_url(url)
+        status.set(f"✅ تم التحميل: {title}\n⏳ عم أرسل الملف…")
+        with span("open", kind):
+            f = file_path.open("rb")
+        with f, span("upload", kind):
+            # الملف على الديسك اسمه id، بس للمستخدم منبعته باسم الفيديو
+            sent = await update.message.reply_document(document=f, filename=f"{title}{file_path.suffix}")
+        delivered = file_path
+    finally:
+        if job_dir:
+            await asyncio.to_thread(janitor.release, job_dir, delivered)
+
+    file_id = sent.document.file_id if sent.document else None
+    if key and file_id:
+        try:
+            media_cache.put(key, file_id, title=title, file_size=sent.document.file_size)
+        except Exception:
+            # الملف وصل للمستخدم؛ الكاش مش سبب نقول إنه فشل
+            logger.exception(f"⚠️ could not cache file_id for {key}:")
+    return {"file_id": file_id, "title": title, "message": update.message}
 
 # =========================
 # Bot handlers
@@ -214,87 +549,679 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📌 طريقة الاستخدام:\n"
         "1) ابعت رابط الفيديو مباشرة.\n"
         "2) انتظر لحد ما يخلص التحميل.\n\n"
+        f"فيك تبعت كذا رابط بنفس الرسالة (لحد {BATCH_MAX_ITEMS})، أو playlist يوتيوب / بروفايل TikTok "
+        f"(أول {PLAYLIST_MAX_ITEMS} فيديو)، وبيوصلوك مجموعات من {MEDIA_GROUP_SIZE}.\n\n"
         "إذا YouTube فشل: جرّب تحديث cookies.txt.\n"
         "إذا TikTok فشل: جرّب cookies أو Proxy."
     )
 
+def queue_full_text(reason: str) -> str:
+    if reason == "user":
+        return "🚦 عندك كذا فيديو عم يتحمّل هلق. استنى لحد ما يخلصوا وبعدين ابعت غيرهم."
+    return "🚦 البوت مشغول كتير هلق. جرّب كمان شوي."
+
 async def download_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = (update.message.text or "").strip()
+    urls = extract_urls(update.message.text or "", limit=BATCH_MAX_ITEMS)
 
-    if not url.startswith(("http://", "https://")):
+    if not urls:
         await update.message.reply_text(WELCOME_TEXT)
         return
 
+    trace_id = new_trace_id()
+    user = update.effective_user.id if update.effective_user else "?"
+    batch = len(urls) > 1 or (PLAYLIST_MAX_ITEMS > 0 and is_collection_url(urls[0]))
+    if batch:
+        logger.info(f"📦 batch of {len(urls)} links from user={user}")
+    else:
+        logger.info(f"🔗 {classify_url(urls[0])} link from user={user}: {urls[0]}")
+    status = StatusMessage(await update.message.reply_text("⏳ عم حمّل الفيديو…"))
+
+    if job_queue is not None:
+        await enqueue_link(update, status, urls, trace_id, batch)
+    elif batch:
+        await process_batch(update, status, urls)
+    else:
+        await process_link(update, status, urls[0])
+
+async def enqueue_link(update: Update, status: StatusMessage, urls: list[str], trace_id: str, batch: bool) -> None:
+    # RUN_MODE=web: منخزّن كل شي بيلزم الـ worker يكمّل (الـ update + رسالة الحالة)
+    kind = "batch" if batch else classify_url(urls[0])
+    user_id = update.effective_user.id if update.effective_user else 0
+    payload = {
+        "url": urls[0],
+        "trace_id": trace_id,
+        "update": update.to_dict(),
+        "status": status.message.to_dict(),
+    }
+    if batch:
+        payload["urls"] = urls
+    try:
+        job_id = await asyncio.to_thread(job_queue.enqueue, kind, user_id, payload)
+    except QueueFull as e:
+        JOBS_TOTAL.inc(kind=kind, outcome="queue_full")
+        logger.warning(f"🚦 job queue full ({e.reason})")
+        await status.update(queue_full_text(e.reason))
+        return
+    logger.info(f"📨 queued job #{job_id} for {len(urls)} link(s)")
+    status.set("⏳ طلبك بالدور…")
+
+async def run_flight(key: str, fn):
+    job = current_job.get()
+    if job is not None:
+        job_flights.setdefault(job.id, set()).add(key)
+    return await downloads.do(key, fn)
+
+async def record_delivery(urls: list[str]) -> None:
+    # RUN_MODE=worker: منسجّل شو انبعت، حتى إذا مات الـ worker الإعادة ما تبعته مرة تانية
+    job = current_job.get()
+    if job is None or not urls:
+        return
+    job.checkpoint["delivered"] = [*job.checkpoint.get("delivered", []), *urls]
+    try:
+        if not await asyncio.to_thread(job_queue.checkpoint, job.id, job.token, job.checkpoint):
+            logger.warning(f"⚠️ could not checkpoint job #{job.id} (lease lost?)")
+    except Exception:
+        # الإرسال صار؛ بس محاولة تانية ممكن تبعته مرة تانية
+        logger.exception(f"⚠️ could not checkpoint job #{job.id}:")
+
+async def process_link(update: Update, status: StatusMessage, url: str) -> str:
+    t0 = time.perf_counter()
+    outcome = "error"
     kind = classify_url(url)
-    msg = await update.message.reply_text("⏳ عم حمّل الفيديو…")
+    joined = False
 
     try:
-        info = await run_yt_dlp_download(url)
+        key = canonical_key_from_url(url)
+        if key and await send_cached(update, status, key, kind):
+            outcome = "cached"
+            await record_delivery([url])
+            return outcome
 
-        title = safe_filename(info.get("title") or "video")
-        file_path = find_downloaded_file(info)
+        flight_key = key or url
+        joined = downloads.is_running(flight_key)
+        if joined:
+            status.set("⏳ نفس الفيديو عم يتحمّل لطلب تاني، رح يوصلك أول ما يخلص…")
 
-        if not file_path:
-            await msg.edit_text(f"✅ تم التحميل: {title}\nبس ما قدرت أحدد مسار الملف.")
-            return
+        try:
+            result = await run_flight(flight_key, lambda: fetch_and_upload(url, key, update, status))
+        except QueueFull as e:
+            if not (joined and e.reason == "user"):
+                raise
+            # الحد تبع مستخدم تاني (الـ leader) مش إلنا -> منجرّب مرة وحدة نكون نحنا الـ leader
+            logger.info(f"🔁 leader of {flight_key} hit its per-user limit, retrying as leader")
+            joined = downloads.is_running(flight_key)
+            result = await run_flight(flight_key, lambda: fetch_and_upload(url, key, update, status))
+
+        if not result.get("file_id"):
+            outcome = "no_file"
+            await status.update(f"✅ تم التحميل: {result['title']}\nبس ما قدرت أحدد مسار الملف.")
+            return outcome
+
+        # الـ leader بعت الملف بنفسه، الباقي بياخدوا نفس الـ file_id
+        if result.get("message") is not update.message:
+            with span("resend", kind):
+                await update.message.reply_document(document=result["file_id"])
+            outcome = "joined" if joined else "cached"
+        else:
+            outcome = "cached" if result.get("cached") else "sent"
+        await record_delivery([url])
+        await status.update(f"✅ تم الإرسال بنجاح: {result['title']}")
+
+    except TooLarge as e:
+        outcome = "too_large"
+        logger.warning(f"📦 too large for Telegram: {e}")
+        # الحجم مش دايماً معروف (yt-dlp تخطّى الملف بدون ما يقول قديش)
+        size = f" (~{e.estimated / 1024 / 1024:.0f}MB)" if e.estimated else ""
+        await status.update(
+            f"⚠️ الفيديو كبير كتير{size}.\n"
+            f"تيليغرام ما بيقبل ملفات أكبر من {MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB للبوتات."
+        )
+
+    except RetryAfter as e:
+        # flood limit حتى بعد الـ retries — مش فشل تحميل، وما في داعي نعدّل الرسالة
+        outcome = "flood_limited"
+        logger.warning(f"⏳ gave up after RetryAfter: {e}")
 
-        await msg.edit_text(f"✅ تم التحميل: {title}\n⏳ عم أرسل الملف…")
-        with file_path.open("rb") as f:
-            await update.message.reply_document(document=f, filename=file_path.name)
-        await msg.edit_text(f"✅ تم الإرسال بنجاح: {title}")
+    except QueueFull as e:
+        outcome = "queue_full"
+        logger.warning(f"🚦 queue full ({e.reason}) stats={scheduler.stats()}")
+        # إذا انضمّينا لـ job غيرنا، الرفض "user" كان على حد صاحبه مش علينا
+        await status.update(queue_full_text("queue" if joined else e.reason))
 
     except Exception:
         logger.exception("❌ Download error (full traceback):")
 
         if kind == "tiktok":
-            await msg.edit_text(
+            await status.update(
                 "⚠️ فشل التحميل من TikTok.\n"
-                "إذا استمر: تأكد cookies.txt أو جرّب PROXY_URL."
+                "إذا استمر: تأكد cookies.txt أو جرّب proxy.txt / PROXY_URL."
             )
         elif kind == "youtube":
-            await msg.edit_text(
+            await status.update(
                 "⚠️ فشل التحميل من YouTube.\n"
                 "إذا ظهر (Sign in / not a bot): صدّر cookies اليوتيوب من جديد.\n"
                 "إذا ظهر (Requested format not available): الكود لازم يتحدث (وهذا الكود مصلّحها)."
             )
         else:
-            await msg.edit_text("⚠️ فشل التحميل. قد يكون الرابط غير مدعوم أو محمي.")
+            await status.update("⚠️ فشل التحميل. قد يكون الرابط غير مدعوم أو محمي.")
+
+    finally:
+        elapsed = time.perf_counter() - t0
+        JOB_SECONDS.observe(elapsed, kind=kind, outcome=outcome)
+        JOBS_TOTAL.inc(kind=kind, outcome=outcome)
+        logger.info(f"🏁 {kind} job finished outcome={outcome} in {elapsed:.2f}s")
+
+    return outcome
+
+# =========================
+# Batch mode (كذا رابط / playlist)
+# =========================
+async def expand_collection(url: str, user_id: int) -> list[str]:
+    # extract_flat: لستة الفيديوهات بس، بدون metadata كل واحد (request واحد تقريباً)
+    kind = classify_url(url)
+
+    def _expand():
+        with ydl_pool.lease(kind) as lease:
+            lease.override(noplaylist=False, extract_flat="in_playlist", playlistend=PLAYLIST_MAX_ITEMS)
+            with span("expand", kind):
+                return lease.ydl.extract_info(url, download=False)
+
+    info = await scheduler.run(kind, user_id, _expand)
+    urls = flat_entry_urls(info)[:PLAYLIST_MAX_ITEMS]
+    logger.info(f"📂 expanded {url} -> {len(urls)} videos")
+    return urls
+
+async def fetch_batch_item(url: str, update: Update) -> dict:
+    # بيرجع يا file_id جاهز (كاش / job تاني) يا ملف على الديسك لسا ما انبعت
+    user_id = update.effective_user.id if update.effective_user else 0
+    key = canonical_key_from_url(url)
+    entry = media_cache.get(key) if key else None
+    if entry:
+        return {"url": url, "key": key, "title": entry.get("title") or "video", "file_id": entry["file_id"], "outcome": "cached"}
+
+    # batch تاني عم يحمّل نفس الفيديو: منستنى التحميل بس ومنبعت نفس الملف بالـ group تبعنا
+    # (إذا استنينا الـ upload تبعه، batchين بيستنوا بعض بيعلقوا)
+    flight_key = key or url
+    shared = batch_handoffs.get(flight_key)
+    if shared is not None:
+        await asyncio.wait({shared})
+        if not shared.cancelled() and shared.exception() is None:
+            item = shared.result()
+            if item.get("file_id"):
+                return {**item, "url": url, "outcome": "joined"}
+            if janitor.share(item["job_dir"]):
+                return {"url": url, "key": item["key"], "title": item["title"], "path": item["path"],
+                        "job_dir": item["job_dir"], "shared": True, "outcome": "joined"}
+
+    # التحميل بيمشي بالـ SingleFlight متل الطلبات العادية. إذا إحنا الـ leader، الملف بيوصلنا
+    # عبر handoff، والـ flight بيخلص بنفس شكل fetch_and_upload ({file_id, title, message})
+    # بس لما الـ media group تبعه ينبعت، فالطلبات العادية يلي بتنضم بتاخد الـ file_id.
+    loop = asyncio.get_running_loop()
+    handoff: asyncio.Future = loop.create_future()
+
+    async def _download_for_batch() -> dict:
+        batch_handoffs[flight_key] = handoff
+        try:
+            return await _download_and_wait_upload()
+        finally:
+            if batch_handoffs.get(flight_key) is handoff:
+                del batch_handoffs[flight_key]
+
+    async def _download_and_wait_upload() -> dict:
+        try:
+            info = await run_yt_dlp_download(url, user_id=user_id)
+        except BaseException as e:
+            if not handoff.done():
+                handoff.set_exception(e)
+            raise
+        entry = info.get("_cached")
+        title = safe_filename(info.get("title") or "video")
+        if entry:
+            result = {"file_id": entry["file_id"], "title": entry.get("title") or title, "message": None}
+            if not handoff.done():
+                handoff.set_result({"url": url, "key": entry["key"], **result, "outcome": "cached"})
+            return result
+
+        file_path = find_downloaded_file(info)
+        job_dir = info.get("_job_dir")
+        if not file_path or handoff.done():
+            # ما في ملف، أو الـ batch انلغى وإحنا عم نحمّل
+            if job_dir:
+                janitor.release(job_dir)
+            error = RuntimeError(f"no file after download: {url}" if not file_path else f"batch gone: {url}")
+            if not handoff.done():
+                handoff.set_exception(error)
+            raise error
+        uploaded: asyncio.Future = loop.create_future()
+        handoff.set_result({
+            "url": url,
+            "key": canonical_key_from_info(info) or key,
+            "title": title,
+            "path": file_path,
+            "job_dir": job_dir,
+            "uploaded": uploaded,
+            "outcome": "sent",
+        })
+        return await uploaded
+
+    flight = asyncio.ensure_future(run_flight(flight_key, _download_for_batch))
+    # الـ exception بيوصلنا من الـ handoff؛ منعلّمه إنه انقرأ
+    flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        await asyncio.wait({flight, handoff}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        handoff.cancel()
+        raise
+    if handoff.done():
+        return handoff.result()
+
+    # انضمّينا لـ flight تاني (طلب عادي أو batch تاني) وخلص بـ file_id
+    handoff.cancel()
+    result = flight.result()
+    if not result.get("file_id"):
+        raise RuntimeError(f"joined download produced no file: {url}")
+    return {"url": url, "key": key, "title": result["title"], "file_id": result["file_id"], "outcome": "joined"}
+
+def _input_media(item: dict, stack: contextlib.ExitStack) -> InputMediaDocument:
+    if item.get("file_id"):
+        return InputMediaDocument(media=item["file_id"])
+    f = stack.enter_context(item["path"].open("rb"))
+    return InputMediaDocument(media=f, filename=f"{item['title']}{item['path'].suffix}")
+
+async def send_batch_chunk(update: Update, items: list[dict]) -> list[dict]:
+    # group واحد (2-10) بـ API call وحدة؛ إذا تيليغرام رفضه منرجع نبعت واحد واحد
+    if len(items) > 1:
+        try:
+            with contextlib.ExitStack() as stack, span("upload", "batch"):
+                media = [_input_media(item, stack) for item in items]
+                sent = await update.message.reply_media_group(media=media)
+            for item, message in zip(items, sent):
+                item["message"] = message
+            return items
+        except BadRequest as e:
+            logger.warning(f"⚠️ media group rejected ({e}), sending {len(items)} items one by one")
+        except Exception as e:
+            # TimedOut / NetworkError / RetryAfter: ما منعرف إذا وصل، فما منعيد الإرسال
+            logger.warning(f"⚠️ media group of {len(items)} failed: {e!r}")
+            return []
+
+    delivered = []
+    for item in items:
+        try:
+            with span("upload", "batch"):
+                if item.get("file_id"):
+                    item["message"] = await update.message.reply_document(document=item["file_id"])
+                else:
+                    with item["path"].open("rb") as f:
+                        item["message"] = await update.message.reply_document(
+                            document=f, filename=f"{item['title']}{item['path'].suffix}"
+                        )
+            delivered.append(item)
+        except BadRequest as e:
+            logger.warning(f"⚠️ could not send {item['url']}: {e}")
+            if item.get("file_id") and item.get("key"):
+                # file_id قديم: منحذفه، والـ batch بيرجع يحمّل الفيديو من جديد
+                media_cache.invalidate(item["key"])
+                item["stale"] = True
+        except Exception as e:
+            logger.warning(f"⚠️ could not send {item['url']}: {e!r}")
+    return delivered
+
+def _finish_batch_item(item: dict) -> None:
+    # الـ pin تبع المجلد بينفك مرة وحدة بس (pop)
+    message = item.get("message")
+    document = message.document if message else None
+    job_dir = item.pop("job_dir", None)
+    try:
+        if job_dir:
+            # ملف مشترك مع batch تاني: كامل على الديسك، منفك الـ pin تبعنا بس
+            delivered = document or item.get("shared")
+            janitor.release(job_dir, media=item["path"] if delivered else None)
+        if document and job_dir and item.get("key"):
+            media_cache.put(item["key"], document.file_id, title=item["title"], file_size=document.file_size)
+    except Exception:
+        # bookkeeping بعد الإرسال: ما بيخرّب الـ batch ولا بيوقف الـ uploaded تحت
+        logger.exception(f"⚠️ post-send bookkeeping failed for {item['url']}:")
+    # الطلبات يلي انضمّت للـ flight تبع هالـ item
+    uploaded = item.pop("uploaded", None)
+    if uploaded is not None and not uploaded.done():
+        if document:
+            uploaded.set_result({"file_id": document.file_id, "title": item["title"], "message": message})
+        else:
+            uploaded.set_exception(RuntimeError(f"batch upload failed: {item['url']}"))
+
+async def process_batch(update: Update, status: StatusMessage, urls: list[str]) -> str:
+    t0 = time.perf_counter()
+    user_id = update.effective_user.id if update.effective_user else 0
+
+    # 1) playlists/بروفايلات -> روابط فيديوهات (بالتوازي)
+    async def _links(url: str) -> list[str]:
+        return await expand_collection(url, user_id) if is_collection_url(url) else [url]
+
+    if PLAYLIST_MAX_ITEMS > 0:
+        expanded = await asyncio.gather(*(_links(u) for u in urls), return_exceptions=True)
+        items: list[str] = []
+        for url, result in zip(urls, expanded):
+            if isinstance(result, BaseException):
+                logger.warning(f"⚠️ could not expand {url}: {result!r}")
+                continue
+            items.extend(result)
+        urls = extract_urls(" ".join(items), limit=BATCH_MAX_ITEMS)
+
+    # RUN_MODE=worker: محاولة سابقة بعتت قسم منهن
+    job = current_job.get()
+    already = set(job.checkpoint.get("delivered", [])) if job else set()
+    if already:
+        logger.info(f"♻️ {len(already)} batch items already delivered, skipping them")
+        urls = [u for u in urls if u not in already]
+        if not urls:
+            await status.update("✅ تم الإرسال بنجاح")
+            return "sent"
+
+    progress = BatchProgress(len(urls))
+    if not urls:
+        await status.update(progress.summary())
+        return "error"
+    status.set(progress.render())
+
+    # 2) كل الفيديوهات بالتوازي، بحدود الـ scheduler (الحد تبع المستخدم)
+    gate = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def _fetch(url: str, retry: bool = False) -> dict | None:
+        kind = classify_url(url)
+        async with gate:
+            try:
+                item = await fetch_batch_item(url, update)
+            except Exception as e:
+                outcome = "too_large" if isinstance(e, TooLarge) else "queue_full" if isinstance(e, QueueFull) else "error"
+                logger.warning(f"⚠️ batch item failed ({outcome}) {url}: {e!r}")
+                JOBS_TOTAL.inc(kind=kind, outcome=outcome)
+                progress.failed.append(url)
+                status.set(progress.render())
+                return None
+        if not retry:
+            progress.ready += 1
+        status.set(progress.render())
+        return item
+
+    async def _send(chunk: list[dict]) -> list[dict]:
+        try:
+            return await send_batch_chunk(update, chunk)
+        except Exception:
+            # الـ items تبع هالـ chunk بيتعلّموا فاشلين، والـ batch بيكمّل
+            logger.exception(f"❌ sending batch chunk of {len(chunk)} failed:")
+            return []
+        finally:
+            for item in chunk:
+                _finish_batch_item(item)
+
+    tasks = [asyncio.create_task(_fetch(url)) for url in urls]
+
+    # 3) media groups بالترتيب: أول 10 بينبعتوا وهني عم يتحمّلوا الباقي
+    try:
+        for i in range(0, len(tasks), MEDIA_GROUP_SIZE):
+            chunk = [item for item in await asyncio.gather(*tasks[i:i + MEDIA_GROUP_SIZE]) if item]
+            if not chunk:
+                continue
+            delivered = await _send(chunk)
+            stale = [item for item in chunk if item.get("stale")]
+            if stale:
+                # file_id قديم (انحذف من الكاش): منحمّل هالفيديوهات من جديد مرة وحدة
+                logger.info(f"♻️ {len(stale)} cached batch items rejected, re-downloading")
+                retried = [item for item in await asyncio.gather(*(_fetch(i["url"], retry=True) for i in stale)) if item]
+                chunk = [item for item in chunk if not item.get("stale")] + retried
+                if retried:
+                    delivered += await _send(retried)
+            for item in chunk:
+                if item in delivered:
+                    JOBS_TOTAL.inc(kind=classify_url(item["url"]), outcome=item["outcome"])
+                else:
+                    JOBS_TOTAL.inc(kind=classify_url(item["url"]), outcome="error")
+                    progress.failed.append(item["url"])
+            progress.sent += len(delivered)
+            await record_delivery([item["url"] for item in delivered])
+            status.set(progress.render())
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # الملفات يلي تحمّلت وما انبعتت منفك الـ pin تبعها
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.result():
+                _finish_batch_item(task.result())
+        raise
+
+    outcome = "sent" if progress.sent == progress.total else "partial" if progress.sent else "error"
+    await status.update(progress.summary())
+    elapsed = time.perf_counter() - t0
+    JOB_SECONDS.observe(elapsed, kind="batch", outcome=outcome)
+    logger.info(f"🏁 batch of {progress.total} finished sent={progress.sent} failed={len(progress.failed)} in {elapsed:.2f}s")
+    return outcome
 
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("help", help_cmd))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, download_video))
 
 # =========================
-# Flask routes
+# Web server (نفس الـ event loop تبع البوت)
+# =========================
+class IndexHandler(RequestHandler):
+    def get(self):
+        self.write("✅ Bot is running on Render!")
+
+class StatsHandler(RequestHandler):
+    def get(self):
+        self.write({
+            "scheduler": scheduler.stats(),
+            "media_cache": media_cache.stats(),
+            "ydl_pool": ydl_pool.stats(),
+            "outbound": rate_limiter.stats(),
+            "downloads_dir": janitor.stats(),
+            "updates": {"pending": update_processor.pending, "max_pending": MAX_PENDING_UPDATES},
+            "job_queue": job_queue.stats() if job_queue else None,
+            "job_worker": job_worker.stats() if job_worker else None,
+            "run_mode": RUN_MODE,
+        })
+
+class WebhookHandler(RequestHandler):
+    def post(self, secret: str):
+        # مقارنة constant-time للسر (بالمسار وبالـ header)
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            self.send_error(404)
+            return
+        if WEBHOOK_HEADER_TOKEN:
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), WEBHOOK_HEADER_TOKEN.encode()):
+                self.send_error(403)
+                return
+
+        if draining.is_set() or update_processor.pending >= MAX_PENDING_UPDATES:
+            logger.warning(f"🚦 rejecting update, pending={update_processor.pending}")
+            self.send_error(503)
+            return
+
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, application.bot)
+        except Exception:
+            logger.exception("❌ Error handling webhook (full traceback):")
+            self.send_error(400)
+            return
+
+        # منرجّع 200 فوراً؛ المعالجة بتصير بالـ update_queue تبع PTB
+        update_processor.pending += 1
+        application.update_queue.put_nowait(update)
+        self.write("OK")
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        # الـ gauges والعدّادات منحدّثها وقت الـ scrape من الـ stats
+        sched = scheduler.stats()
+        cache = media_cache.stats()
+        GAUGES.set(sched["queued"], name="queue_depth")
+        GAUGES.set(sum(sched["running"].values()), name="downloads_running")
+        GAUGES.set(sched["wait_max"], name="queue_wait_max_seconds")
+        QUEUE_REJECTED.set(sched["rejected"])
+        GAUGES.set(cache["entries"], name="media_cache_entries")
+        MEDIA_CACHE_HITS.set(cache["hits"])
+        MEDIA_CACHE_MISSES.set(cache["misses"])
+        GAUGES.set(update_processor.pending, name="updates_pending")
+        outbound = rate_limiter.stats()
+        TELEGRAM_REQUESTS.set(outbound["requests"])
+        TELEGRAM_RETRY_AFTER.set(outbound["retries"])
+        TELEGRAM_WAIT_SECONDS.set(outbound["waited"])
+        disk = janitor.stats()
+        GAUGES.set(disk["disk_bytes"], name="download_dir_bytes")
+        GAUGES.set(disk["entries"], name="download_dir_entries")
+        EVICTED_ENTRIES.set(disk["evicted_entries"])
+        EVICTED_BYTES.set(disk["evicted_bytes"])
+        WARM_HITS.set(disk["warm_hits"])
+        if job_queue:
+            jobs = job_queue.stats()
+            GAUGES.set(jobs["queued"], name="jobs_queued")
+            GAUGES.set(jobs["running"], name="jobs_running")
+            GAUGES.set(jobs["oldest_queued_age"], name="jobs_oldest_queued_age_seconds")
+            LEASES_EXPIRED.set(jobs["expired"])
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(registry.render())
+
+web_app = WebApplication([
+    (r"/", IndexHandler),
+    (r"/stats", StatsHandler),
+    (r"/metrics", MetricsHandler),
+    (r"/webhook/([^/]+)", WebhookHandler),
+])
+worker_web_app = WebApplication([
+    (r"/", IndexHandler),
+    (r"/stats", StatsHandler),
+    (r"/metrics", MetricsHandler),
+])
+
+# =========================
+# Worker (RUN_MODE=worker)
 # =========================
-@app.get("/")
-def index():
-    return "✅ Bot is running on Render!"
-
-@app.post(f"/webhook/{WEBHOOK_SECRET}")
-def webhook():
-    data = request.get_json(silent=True)
-    if not data:
-        abort(400)
+def _stop_job_flights(job: LeasedJob) -> None:
+    # الـ shield بيخلّي التحميل/الرفع يكمّل حتى لو انلغى الـ job؛ منوقفه إذا ما حدا غيرنا مستنيه
+    for key in job_flights.get(job.id, ()):
+        if downloads.waiters(key) <= 1:
+            downloads.cancel(key)
+
+async def handle_job(job: LeasedJob) -> dict:
+    trace_id_var.set(job.payload.get("trace_id") or "-")
+    current_job.set(job)
+    url = job.payload.get("url")
+    delivered = job.checkpoint.get("delivered", [])
+    logger.info(f"🛠️ job #{job.id} attempt {job.attempts} on {WORKER_ID}: {url}")
+
     try:
-        update = Update.de_json(data, application.bot)
-        asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
-    except Exception:
-        logger.exception("❌ Error handling webhook (full traceback):")
-    return "OK", 200
+        update = Update.de_json(job.payload["update"], application.bot)
+        status = StatusMessage(Message.de_json(job.payload["status"], application.bot))
+        if url in delivered and not job.payload.get("urls"):
+            # المحاولة يلي قبل بعتت الملف وماتت قبل ما تخلّص
+            outcome = "sent"
+            await status.update("✅ تم الإرسال بنجاح")
+        elif job.attempts > JOB_MAX_ATTEMPTS:
+            # الـ workers يلي قبلنا ماتوا بنص هالـ job كذا مرة -> ما منجرّب كمان
+            outcome = "abandoned"
+            JOBS_TOTAL.inc(kind=job.kind, outcome=outcome)
+            await status.update("⚠️ فشل التحميل بعد كذا محاولة. جرّب كمان شوي.")
+        elif job.payload.get("urls"):
+            # process_batch بيتخطّى الفيديوهات يلي انبعتت بمحاولة قبل
+            outcome = await process_batch(update, status, job.payload["urls"])
+        else:
+            outcome = await process_link(update, status, url)
+    finally:
+        job_flights.pop(job.id, None)
+    return {"outcome": outcome}
+
+job_worker = None
+if RUN_MODE == "worker":
+    job_worker = JobWorker(
+        job_queue,
+        owner=WORKER_ID,
+        handle=handle_job,
+        concurrency=DOWNLOAD_WORKERS,
+        lease_seconds=JOB_LEASE_SECONDS,
+        poll_interval=JOB_POLL_INTERVAL,
+        drain_timeout=SHUTDOWN_DRAIN_TIMEOUT,
+        retention=JOB_RETENTION,
+        on_lost=_stop_job_flights,
+        # حتى ما يكمّل الرفع بعد ما رجّعنا الـ job (كان رح يوصل مرتين)
+        on_drain_timeout=downloads.cancel_all,
+    )
 
 # =========================
-# Startup
+# Startup / shutdown
 # =========================
+draining = asyncio.Event()
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    running_loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        running_loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def worker_main():
+    logger.info(f"🚀 Starting download worker {WORKER_ID}...")
+    await application.initialize()
+    await asyncio.to_thread(ydl_pool.warm)
+    janitor_task = asyncio.create_task(janitor.run(JANITOR_INTERVAL))
+
+    server = None
+    if WORKER_PORT:
+        server = HTTPServer(worker_web_app)
+        server.listen(WORKER_PORT, address="0.0.0.0")
+
+    logger.info(f"🛠️ worker {WORKER_ID} polling {JOB_QUEUE_URL}")
+    await job_worker.run(_stop_event())
+
+    if server:
+        server.stop()
+    await application.shutdown()
+    janitor_task.cancel()
+    scheduler.shutdown()
+    logger.info("👋 Bye")
+
 async def main():
-    logger.info("🚀 Starting Telegram bot...")
+    if RUN_MODE == "worker":
+        await worker_main()
+        return
+
+    logger.info(f"🚀 Starting Telegram bot (RUN_MODE={RUN_MODE})...")
     logger.info(f"✅ ffmpeg_location = {FFMPEG_EXE}")
     await application.initialize()
     await application.start()
-    await application.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}")
+    janitor_task = None
+    if RUN_MODE == "all":
+        await asyncio.to_thread(ydl_pool.warm)
+        janitor_task = asyncio.create_task(janitor.run(JANITOR_INTERVAL))
+
+    server = HTTPServer(web_app, xheaders=True)
+    server.listen(PORT, address="0.0.0.0")
+
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}",
+        secret_token=WEBHOOK_HEADER_TOKEN,
+        max_connections=min(100, MAX_CONCURRENT_UPDATES),
+    )
     logger.info("✅ Webhook set and bot is ready!")
 
+    await _stop_event().wait()
+
+    # Graceful drain: ما منقبل شي جديد، ومنستنى الشغل يلي بالطريق
+    logger.info(f"🛑 Shutting down, draining {update_processor.pending} pending updates…")
+    draining.set()
+    server.stop()
+    try:
+        await asyncio.wait_for(application.stop(), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ drain timed out, {update_processor.pending} updates dropped")
+    await application.shutdown()
+    if janitor_task:
+        janitor_task.cancel()
+    scheduler.shutdown()
+    await server.close_all_connections()
+    logger.info("👋 Bye")
+
 if __name__ == "__main__":
-    loop.create_task(main())
-    Thread(target=lambda: app.run(host="0.0.0.0", port=PORT)).start()
-    loop.run_forever()
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+import re
+import sqlite3
+import time
+import logging
+from pathlib import Path
+from threading import Lock
+
+logger = logging.getLogger("telegram_bot.cache")
+
+
+# =========================
+# Canonical keys
+# =========================
+# المفتاح لازم يطابق extractor_key + id تبع yt-dlp
+# (YoutubeIE -> "youtube", TikTokIE -> "tiktok") حتى يتلاقوا الطريقتين
+_YOUTUBE_ID_RE = re.compile(
+    r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)([A-Za-z0-9_-]{11})",
+    re.IGNORECASE,
+)
+_TIKTOK_ID_RE = re.compile(r"tiktok\.com/(?:@[^/?#]*/(?:video|photo)|embed(?:/v2)?|v)/(\d+)", re.IGNORECASE)
+
+def canonical_key_from_url(url: str) -> str | None:
+    # بدون أي network call — الروابط القصيرة (vm.tiktok.com) بترجع None
+    u = (url or "").strip()
+    m = _YOUTUBE_ID_RE.search(u)
+    if m:
+        return f"youtube:{m.group(1)}"
+    m = _TIKTOK_ID_RE.search(u)
+    if m:
+        return f"tiktok:{m.group(1)}"
+    return None
+
+def canonical_key_from_info(info: dict) -> str | None:
+    extractor = info.get("extractor_key") or info.get("extractor")
+    video_id = info.get("id")
+    if not extractor or not video_id:
+        return None
+    return f"{str(extractor).lower()}:{video_id}"
+
+
+# =========================
+# SQLite cache
+# =========================
+class MediaCache:
+    """Maps a canonical video key to the Telegram file_id of its first upload."""
+
+    def __init__(self, path: Path, ttl: int, max_entries: int):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            " key TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " title TEXT,"
+            " file_size INTEGER,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS media_last_used ON media(last_used_at)")
+        self.evict()
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_id, title, file_size, created_at FROM media WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.ttl > 0 and now - row[3] > self.ttl:
+                self._db.execute("DELETE FROM media WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE media SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return {"file_id": row[0], "title": row[1], "file_size": row[2]}
+
+    def put(self, key: str, file_id: str, title: str | None = None, file_size: int | None = None) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO media (key, file_id, title, file_size, created_at, last_used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id, title = excluded.title,"
+                " file_size = excluded.file_size, created_at = excluded.created_at,"
+                " last_used_at = excluded.last_used_at",
+                (key, file_id, title, file_size, now, now),
+            )
+        self.evict()
+
+    def invalidate(self, key: str) -> None:
+        # مثلاً لما تيليغرام يرفض file_id قديم
+        with self._lock:
+            self._db.execute("DELETE FROM media WHERE key = ?", (key,))
+
+    def evict(self) -> int:
+        removed = 0
+        with self._lock:
+            if self.ttl > 0:
+                cur = self._db.execute("DELETE FROM media WHERE created_at < ?", (time.time() - self.ttl,))
+                removed += cur.rowcount
+            if self.max_entries > 0:
+                cur = self._db.execute(
+                    "DELETE FROM media WHERE key IN ("
+                    " SELECT key FROM media ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                removed += cur.rowcount
+            self.evictions += removed
+        if removed:
+            logger.info(f"🧹 media cache evicted {removed} entries")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._db.execute("SELECT COUNT(*) FROM media").fetchone()
+        return {"entries": entries, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
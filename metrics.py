@@ -0,0 +1,274 @@
+import time
+import uuid
+import logging
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+
+# =========================
+# Trace IDs (بتنحط بكل سطر log)
+# =========================
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+def new_trace_id() -> str:
+    trace_id = uuid.uuid4().hex[:8]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+# =========================
+# Prometheus text format (بدون مكتبة خارجية)
+# =========================
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.label_names, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class MirroredCounter(Counter):
+    """A counter whose value is a component's own running total, copied at scrape time."""
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [counts per bucket, sum, count]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, n) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = f'le="{_fmt_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {_fmt_value(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# =========================
+# Bot metrics
+# =========================
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "bot_stage_seconds", "Time spent per pipeline stage.",
+    ("stage", "kind", "outcome"), SECONDS_BUCKETS,
+))
+JOB_SECONDS = registry.register(Histogram(
+    "bot_job_seconds", "End-to-end time per link, from message to final status.",
+    ("kind", "outcome"), SECONDS_BUCKETS,
+))
+JOBS_TOTAL = registry.register(Counter(
+    "bot_jobs_total", "Links handled, by platform and outcome.", ("kind", "outcome"),
+))
+DOWNLOAD_BYTES = registry.register(Counter(
+    "bot_download_bytes_total", "Media bytes downloaded by yt-dlp.", ("kind",),
+))
+DOWNLOAD_THROUGHPUT = registry.register(Histogram(
+    "bot_download_throughput_bytes_per_second", "Per-job download throughput.",
+    ("kind",), THROUGHPUT_BUCKETS,
+))
+GAUGES = registry.register(Gauge(
+    "bot_state", "Point-in-time state (queue depth, running jobs, cache size, updates).", ("name",),
+))
+
+# عدّادات كل component بيعدّها لحاله (stats()) ومنحطها هون وقت الـ scrape
+def _mirrored(name: str, help_text: str) -> MirroredCounter:
+    return registry.register(MirroredCounter(name, help_text))
+
+QUEUE_REJECTED = _mirrored("bot_queue_rejected_total", "Downloads refused by the scheduler (queue or per-user limit).")
+MEDIA_CACHE_HITS = _mirrored("bot_media_cache_hits_total", "file_id cache hits.")
+MEDIA_CACHE_MISSES = _mirrored("bot_media_cache_misses_total", "file_id cache misses.")
+TELEGRAM_REQUESTS = _mirrored("bot_telegram_requests_total", "Bot API requests sent through the rate limiter.")
+TELEGRAM_RETRY_AFTER = _mirrored("bot_telegram_retry_after_total", "Bot API requests retried after a RetryAfter (429).")
+TELEGRAM_WAIT_SECONDS = _mirrored(
+    "bot_telegram_rate_limit_wait_seconds_total", "Time requests spent waiting on rate-limit buckets.",
+)
+EVICTED_ENTRIES = _mirrored("bot_download_dir_evicted_entries_total", "Download directories evicted by the janitor.")
+EVICTED_BYTES = _mirrored("bot_download_dir_evicted_bytes_total", "Bytes evicted from the download directory.")
+WARM_HITS = _mirrored("bot_download_dir_warm_hits_total", "Re-uploads served from a file still on disk.")
+LEASES_EXPIRED = _mirrored("bot_jobs_lease_expired_total", "Job leases that expired and were retried.")
+
+
+# انتظار الـ rate limiter جوّا الـ span الحالي (OutboundRateLimiter بيزيد عليه)
+_span_wait: contextvars.ContextVar[list[float] | None] = contextvars.ContextVar("span_wait", default=None)
+
+def add_rate_limit_wait(seconds: float) -> None:
+    cell = _span_wait.get()
+    if cell is not None:
+        cell[0] += seconds
+
+@contextmanager
+def span(stage: str, kind: str):
+    """Time a stage; any Bot API rate-limit wait inside it is recorded as its own "rate_limit" stage."""
+    t0 = time.perf_counter()
+    outcome = "ok"
+    waited = [0.0]
+    token = _span_wait.set(waited)
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _span_wait.reset(token)
+        elapsed = time.perf_counter() - t0
+        if waited[0] > 0:
+            STAGE_SECONDS.observe(waited[0], stage="rate_limit", kind=kind, outcome="ok")
+        STAGE_SECONDS.observe(max(elapsed - waited[0], 0.0), stage=stage, kind=kind, outcome=outcome)
+
+
+class DownloadTracker:
+    """yt-dlp progress/postprocessor hooks -> download and merge timings."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.bytes = 0
+        self._download_started: float | None = None
+        self._download_finished: float | None = None
+        self._downloading = False
+        self._pp_started: dict[str, float] = {}
+
+    def on_progress(self, d: dict) -> None:
+        now = time.perf_counter()
+        if d.get("status") == "downloading":
+            self._downloading = True
+            if self._download_started is None:
+                self._download_started = now
+        elif d.get("status") == "finished":
+            self._downloading = False
+            self._download_started = self._download_started or now - (d.get("elapsed") or 0)
+            self._download_finished = now
+            self.bytes += d.get("total_bytes") or d.get("downloaded_bytes") or 0
+
+    def on_postprocess(self, d: dict) -> None:
+        name = d.get("postprocessor") or "?"
+        if d.get("status") == "started":
+            self._pp_started[name] = time.perf_counter()
+        elif d.get("status") == "finished" and name in self._pp_started:
+            stage = "merge" if name == "Merger" else "postprocess"
+            STAGE_SECONDS.observe(
+                time.perf_counter() - self._pp_started.pop(name), stage=stage, kind=self.kind, outcome="ok",
+            )
+
+    def finish(self, outcome: str = "ok") -> None:
+        """Record the download (and any unfinished postprocessor) once the download ends, ok or not."""
+        now = time.perf_counter()
+        # postprocessor بلّش وما خلص = هو يلي فشل
+        for name, started in self._pp_started.items():
+            stage = "merge" if name == "Merger" else "postprocess"
+            STAGE_SECONDS.observe(now - started, stage=stage, kind=self.kind, outcome=outcome)
+        self._pp_started.clear()
+
+        if self._download_started is None:
+            return
+        # الفشل عالتحميل نفسه بس إذا كان stream عم ينزل وقتها (مش بالـ merge بعده)
+        failed = outcome != "ok" and (self._downloading or self._download_finished is None)
+        end = now if failed else self._download_finished
+        elapsed = max(end - self._download_started, 1e-6)
+        STAGE_SECONDS.observe(elapsed, stage="download", kind=self.kind, outcome=outcome if failed else "ok")
+        DOWNLOAD_BYTES.inc(self.bytes, kind=self.kind)
+        if self.bytes and not failed:
+            DOWNLOAD_THROUGHPUT.observe(self.bytes / elapsed, kind=self.kind)
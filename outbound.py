@@ -0,0 +1,175 @@
+import time
+import asyncio
+import logging
+import datetime as dtm
+from typing import Any
+
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import add_rate_limit_wait
+
+logger = logging.getLogger("telegram_bot.outbound")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and time.monotonic() >= self.paused_until
+
+
+def _seconds(retry_after: Any) -> float:
+    if isinstance(retry_after, dtm.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """
+    Token buckets in front of every Bot API call: one global, one per private
+    chat and one per group/channel. RetryAfter pauses the affected bucket and
+    the request is retried (up to `max_retries` times).
+    """
+
+    def __init__(
+        self,
+        overall_per_second: float = 30,
+        chat_per_second: float = 1,
+        group_per_minute: float = 20,
+        chat_burst: float = 3,
+        group_burst: float = 5,
+        max_retries: int = 3,
+    ):
+        self.overall = TokenBucket(overall_per_second, overall_per_second)
+        self.chat_per_second = chat_per_second
+        self.group_per_minute = group_per_minute
+        self.chat_burst = chat_burst
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._buckets: dict[int | str, TokenBucket] = {}
+
+        self.requests = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10_000:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.idle}
+            # string chat_id (@channel) أو سالب = group/channel
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_per_second, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        bucket = self._bucket(chat_id) if chat_id is not None else None
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+
+        self.requests += 1
+        for attempt in range(max_retries + 1):
+            t0 = time.monotonic()
+            # الحد العام بس على الطلبات يلي إلها chat (متل ما تيليغرام بيعدّ).
+            # الـ chat/group أول: ما منمسك token عام وإحنا مستنيين group (20/دقيقة)
+            if bucket is not None:
+                await bucket.acquire()
+                await self.overall.acquire()
+            waited = time.monotonic() - t0
+            self.waited += waited
+            # الـ span تبع الطلب (upload/resend) بيعدّ هالوقت لحاله
+            add_rate_limit_wait(waited)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                sleep = _seconds(e.retry_after) + 0.1
+                self.retries += 1
+                logger.warning(f"⏳ RetryAfter {sleep:.1f}s on {endpoint} chat={chat_id}, retry {attempt + 1}")
+                (bucket or self.overall).pause(sleep)
+                if bucket is None:
+                    await asyncio.sleep(sleep)
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "retries": self.retries, "waited": round(self.waited, 3), "chats": len(self._buckets)}
+
+
+class StatusMessage:
+    """
+    A status message whose edits are coalesced: while one edit is in flight,
+    newer texts replace the pending one, so only the latest state is sent.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._latest = message.text
+        self._sent = message.text
+        self._task: asyncio.Task | None = None
+        self.superseded = 0
+
+    def set(self, text: str) -> None:
+        if self._latest != self._sent:
+            self.superseded += 1
+        self._latest = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+            self._task.add_done_callback(self._log_failure)
+
+    async def update(self, text: str) -> None:
+        # للحالات النهائية: منستنى لحد ما توصل
+        self.set(text)
+        await self._task
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"⚠️ status edit failed: {task.exception()!r}")
+
+    async def _flush(self) -> None:
+        while self._latest != self._sent:
+            text = self._latest
+            try:
+                await self.message.edit_text(text)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            self._sent = text
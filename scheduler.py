@@ -0,0 +1,209 @@
+import time
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from typing import Any
+
+logger = logging.getLogger("telegram_bot.scheduler")
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler refuses a job (global or per-user limit)."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Job:
+    def __init__(self, job_id: int, kind: str, user_id: int, fn: Callable[[], Any]):
+        self.id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.fn = fn
+        self.enqueued_at = time.monotonic()
+        self.started_at: float | None = None
+        self.started = asyncio.Event()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.monotonic()) - self.enqueued_at
+
+
+def parse_caps(raw: str) -> dict[str, int]:
+    # "youtube=2,tiktok=3,other=2"
+    caps = {}
+    for part in (raw or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip().isdigit():
+            caps[name.strip().lower()] = int(value)
+    return caps
+
+
+class DownloadScheduler:
+    """
+    Bounded job queue in front of a dedicated thread pool.
+
+    Jobs are picked round-robin across users, and a job only starts when its
+    platform (classify_url kind) is below its concurrency cap.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        caps: dict[str, int],
+        max_queue: int,
+        max_per_user: int,
+        on_start: Callable[[Job], None] | None = None,
+    ):
+        self.workers = workers
+        self.caps = caps
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.on_start = on_start
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+        self._ids = count(1)
+        # user_id -> jobs بالترتيب؛ ترتيب الـ dict نفسه هو دور الـ round-robin
+        self._pending: OrderedDict[int, deque[Job]] = OrderedDict()
+        self._running: dict[str, int] = {}
+        self._queued = 0
+
+        self.jobs_started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # -------- public --------
+    async def run(self, kind: str, user_id: int, fn: Callable[[], Any], on_queued=None) -> Any:
+        job = self.submit(kind, user_id, fn)
+        watcher = None
+        if on_queued is not None and not job.started.is_set():
+            watcher = asyncio.create_task(on_queued(job))
+        try:
+            return await job.future
+        finally:
+            if watcher:
+                watcher.cancel()
+            if not job.started.is_set():
+                self._discard(job)
+
+    def submit(self, kind: str, user_id: int, fn: Callable[[], Any]) -> Job:
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull("queue")
+        user_queue = self._pending.get(user_id)
+        if user_queue and len(user_queue) >= self.max_per_user:
+            self.rejected += 1
+            raise QueueFull("user")
+
+        job = Job(next(self._ids), kind, user_id, fn)
+        self._pending.setdefault(user_id, deque()).append(job)
+        self._queued += 1
+        self._pump()
+        return job
+
+    def position(self, job: Job) -> int:
+        # 0 = شغّال هلق. غير هيك: ترتيبه التقريبي بالـ round-robin (بدون حساب caps المنصات)
+        if job.started.is_set():
+            return 0
+        user_queue = self._pending.get(job.user_id)
+        if not user_queue or job not in user_queue:
+            return 0
+        rank = user_queue.index(job)
+        ahead = rank
+        before = True
+        for user_id, q in self._pending.items():
+            if user_id == job.user_id:
+                before = False
+                continue
+            # المستخدمين يلي قبله بالدور بياخدوا دورة زيادة
+            ahead += min(len(q), rank + 1 if before else rank)
+        return ahead + 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queued,
+            "running": dict(self._running),
+            "workers": self.workers,
+            "caps": dict(self.caps),
+            "started": self.jobs_started,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_avg": round(self.wait_total / self.jobs_started, 3) if self.jobs_started else 0.0,
+            "wait_max": round(self.wait_max, 3),
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # -------- internals --------
+    def _discard(self, job: Job) -> None:
+        q = self._pending.get(job.user_id)
+        if q and job in q:
+            q.remove(job)
+            self._queued -= 1
+            if not q:
+                del self._pending[job.user_id]
+
+    def _has_capacity(self, kind: str) -> bool:
+        if sum(self._running.values()) >= self.workers:
+            return False
+        cap = self.caps.get(kind, self.caps.get("other", self.workers))
+        return self._running.get(kind, 0) < cap
+
+    def _pump(self) -> None:
+        while self._queued and sum(self._running.values()) < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            self._start(job)
+
+    def _next_job(self) -> Job | None:
+        for user_id in list(self._pending):
+            q = self._pending[user_id]
+            for job in q:
+                if not self._has_capacity(job.kind):
+                    continue
+                q.remove(job)
+                self._queued -= 1
+                # المستخدم بيروح لآخر الدور
+                del self._pending[user_id]
+                if q:
+                    self._pending[user_id] = q
+                return job
+        return None
+
+    def _start(self, job: Job) -> None:
+        job.started_at = time.monotonic()
+        job.started.set()
+        self._running[job.kind] = self._running.get(job.kind, 0) + 1
+        self.jobs_started += 1
+        self.wait_total += job.wait_time
+        self.wait_max = max(self.wait_max, job.wait_time)
+        logger.info(f"▶️ job #{job.id} kind={job.kind} waited={job.wait_time:.2f}s queued={self._queued}")
+        if self.on_start:
+            self.on_start(job)
+
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        fut = loop.run_in_executor(self._executor, ctx.run, job.fn)
+        fut.add_done_callback(lambda f, j=job: self._finish(j, f))
+
+    def _finish(self, job: Job, fut: asyncio.Future) -> None:
+        self._running[job.kind] -= 1
+        self.completed += 1
+        if not job.future.done():
+            if fut.cancelled():
+                job.future.cancel()
+            elif fut.exception() is not None:
+                job.future.set_exception(fut.exception())
+            else:
+                job.future.set_result(fut.result())
+        self._pump()
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+logger = logging.getLogger("telegram_bot.singleflight")
+
+
+class SingleFlight:
+    """Runs at most one job per key; later callers attach to the running job."""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._waiters: dict[str, int] = {}
+
+    def is_running(self, key: str) -> bool:
+        return key in self._inflight
+
+    def waiters(self, key: str) -> int:
+        return self._waiters.get(key, 0)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        else:
+            logger.info(f"🔗 joined in-flight job {key} (waiters={self._waiters.get(key, 0) + 1})")
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: إذا واحد من المنتظرين انلغى، الباقي بيضلوا مستنيين نفس الـ job
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] <= 0:
+                self._waiters.pop(key, None)
+
+    def cancel(self, key: str) -> bool:
+        task = self._inflight.get(key)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def cancel_all(self) -> int:
+        # الـ shield بيخلّي الـ job يكمّل حتى لو المنتظرين انلغوا؛ هون منوقفه عن جد (shutdown)
+        tasks = [t for t in self._inflight.values() if not t.done()]
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # منعلّم الـ exception إنه انقرأ حتى لو كل المنتظرين انلغوا
+        if not task.cancelled():
+            task.exception()
+
@@ -0,0 +1,198 @@
+import queue
+import logging
+from collections.abc import Callable
+from pathlib import Path
+from threading import Lock
+
+import yt_dlp
+
+logger = logging.getLogger("telegram_bot.ydl_pool")
+
+
+class YdlLease:
+    """One pooled YoutubeDL, borrowed for a single job. Per-job params are undone on release."""
+
+    def __init__(self, pool: "YdlPool", kind: str, generation: int, ydl: yt_dlp.YoutubeDL):
+        self.pool = pool
+        self.kind = kind
+        self.generation = generation
+        self.ydl = ydl
+        self._saved: dict = {}
+        self._hooks = (len(ydl._progress_hooks), len(ydl._postprocessor_hooks))
+
+    def override(self, **params) -> None:
+        ydl = self.ydl
+        for name, value in params.items():
+            if name == "progress_hooks":
+                for hook in value:
+                    ydl.add_progress_hook(hook)
+                continue
+            if name == "postprocessor_hooks":
+                for hook in value:
+                    ydl.add_postprocessor_hook(hook)
+                continue
+
+            if name not in self._saved:
+                self._saved[name] = ydl.params.get(name)
+            if name == "outtmpl":
+                value = {**ydl.params["outtmpl"], "default": value}
+            ydl.params[name] = value
+            if name == "format":
+                ydl.format_selector = ydl.build_format_selector(value)
+
+    def _restore(self) -> None:
+        ydl = self.ydl
+        for name, value in self._saved.items():
+            if value is None:
+                ydl.params.pop(name, None)
+            else:
+                ydl.params[name] = value
+            if name == "format":
+                ydl.format_selector = ydl.build_format_selector(value) if value else value
+        del ydl._progress_hooks[self._hooks[0]:]
+        del ydl._postprocessor_hooks[self._hooks[1]:]
+        self._saved.clear()
+
+    def __enter__(self) -> "YdlLease":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.pool._release(self)
+
+
+class YdlPool:
+    """
+    Long-lived, pre-warmed YoutubeDL instances per platform.
+
+    Options come from `build_opts(kind)` once per generation. A new generation
+    starts when one of `watch_files` changes mtime (or appears / disappears);
+    older instances are retired as they come back.
+    """
+
+    def __init__(
+        self,
+        build_opts: Callable[[str], dict],
+        sizes: dict[str, int],
+        watch_files: list[Path] = (),
+    ):
+        self.build_opts = build_opts
+        self.sizes = sizes
+        self.watch_files = [Path(p) for p in watch_files]
+
+        self._lock = Lock()
+        self._generation = 0
+        self._signature = self._current_signature()
+        self._profiles: dict[str, dict] = {}
+        self._cookiejar = None
+        self._idle: dict[str, queue.LifoQueue] = {kind: queue.LifoQueue() for kind in sizes}
+        self._created: dict[str, int] = {kind: 0 for kind in sizes}
+
+        self.leases = 0
+        self.builds = 0
+        self.reloads = 0
+
+    # -------- public --------
+    def warm(self) -> None:
+        for kind, size in self.sizes.items():
+            for _ in range(size - self._created[kind]):
+                try:
+                    ydl = self._build(kind)
+                except Exception as e:
+                    # profile وحدة خربانة (مثلاً impersonate بلا curl_cffi) ما بتوقّف البوت:
+                    # lease() بيرجع يجرّب يبنيها وقت الحاجة
+                    logger.error(f"❌ yt-dlp pool: can't build {kind}: {e}")
+                    break
+                with self._lock:
+                    self._created[kind] += 1
+                self._idle[kind].put((self._generation, ydl))
+        logger.info(f"🔥 yt-dlp pool warmed: {dict(self._created)}")
+
+    def lease(self, kind: str) -> YdlLease:
+        kind = kind if kind in self.sizes else "other"
+        self._check_reload()
+
+        while True:
+            with self._lock:
+                create = self._idle[kind].empty() and self._created[kind] < self.sizes[kind]
+                if create:
+                    self._created[kind] += 1
+            if create:
+                try:
+                    generation, ydl = self._generation, self._build(kind)
+                except BaseException:
+                    with self._lock:
+                        self._created[kind] -= 1
+                    raise
+            else:
+                generation, ydl = self._idle[kind].get()
+            if generation == self._generation:
+                break
+            self._retire(kind, ydl)
+
+        self.leases += 1
+        return YdlLease(self, kind, generation, ydl)
+
+    def stats(self) -> dict:
+        return {
+            "generation": self._generation,
+            "instances": dict(self._created),
+            "idle": {kind: q.qsize() for kind, q in self._idle.items()},
+            "leases": self.leases,
+            "builds": self.builds,
+            "reloads": self.reloads,
+        }
+
+    # -------- internals --------
+    def _current_signature(self) -> tuple:
+        return tuple(p.stat().st_mtime_ns if p.exists() else None for p in self.watch_files)
+
+    def _check_reload(self) -> None:
+        signature = self._current_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            self._signature = signature
+            self._generation += 1
+            self._profiles.clear()
+            self._cookiejar = None
+            self.reloads += 1
+        logger.info(f"♻️ cookies/proxy changed -> yt-dlp pool generation {self._generation}")
+
+    def _profile(self, kind: str) -> dict:
+        with self._lock:
+            if kind not in self._profiles:
+                self._profiles[kind] = self.build_opts(kind)
+            return self._profiles[kind]
+
+    def _build(self, kind: str) -> yt_dlp.YoutubeDL:
+        # كل instance إلها نسخة من الـ options (yt-dlp بيعدّل عليهن)
+        opts = dict(self._profile(kind))
+        ydl = yt_dlp.YoutubeDL(opts)
+        # cookie jar واحد لكل الـ instances (بيتحمّل مرة وحدة بكل generation)
+        if self._cookiejar is None:
+            self._cookiejar = ydl.cookiejar
+        else:
+            ydl.__dict__["cookiejar"] = self._cookiejar
+            # impersonate بيبني الـ request director بالـ __init__ مربوط بالـ jar تبع الـ instance:
+            # منسكّره وبينبنى من جديد (lazy) عالـ jar المشترك
+            director = ydl.__dict__.pop("_request_director", None)
+            if director is not None:
+                director.close()
+        self.builds += 1
+        return ydl
+
+    def _retire(self, kind: str, ydl: yt_dlp.YoutubeDL) -> None:
+        # ما منخلّي yt-dlp يكتب cookies قديمة فوق الملف الجديد
+        ydl.params["cookiefile"] = None
+        ydl.close()
+        with self._lock:
+            self._created[kind] -= 1
+
+    def _release(self, lease: YdlLease) -> None:
+        lease._restore()
+        if lease.generation != self._generation:
+            self._retire(lease.kind, lease.ydl)
+            return
+        self._idle[lease.kind].put((lease.generation, lease.ydl))